@@ -1,63 +1,132 @@
+import importlib
+from typing import Optional
+
 from models import OSMPoint, FlickrPoint, GTFSStop, OSMAccessNode, OoklaPoint, KonturPoint
 
 # Dataset definition schema:
 # 'dataset_id': {
 #   'label': Text to display in analysis UI
+#   'importer': Importer class as 'module.Class'. The module is only loaded when the dataset is imported, so
+#        we don't pay for the libraries of other datasets. The class must have the classmethods
+#        source(city, parameters, logger), returning the parameters other than bbox that identify the imported data,
+#        and import_city(slug, city, bbox, logger, telemetry, engine, parameters), running the import.
+#        Parameters are the parameters of the dataset in the analysis, e.g. {urls: [http://example.com]}
+#        Importers of global sources may also have the classmethod prepare(logger, telemetry, parameters), which
+#        downloads and indexes the sources once, before a batch import.
+#   'memory': Memory in GB the importer needs at its peak
+#   'prepare_memory': (optional) Memory in GB the importer needs when prepare has to download and index the
+#        global sources first. Such importers must have the classmethod prepared(parameters), telling if the
+#        sources are ready.
 #   'model': SQLAlchemy base to use
 #   'name': Name to display in Kepler map
 #   'weight': Weight in the sum (index) layer. Positive weight means layer minimum will get value zero
 #        in the index and layer maximum will get value weight. Negative weight means layer maximum
 #        will get value zero and layer minimum will get value abs(weight).
-#   'group_by': (optional) Field to group points by before plotting. Default None.
+#   'group_by': (optional) Column of the model to group points by before plotting. Default None.
 #   'plot': (optional) Function to use when combining values within one H3 hex. Default 'size'.
 #        Possible functions are https://pandas.pydata.org/docs/reference/groupby.html#computations-descriptive-stats
-#   'column': (optional) Field whose value to plot. Default None will just count point numbers.
+#   'column': (optional) Column of the model whose value to plot. Default None will just count point numbers.
+#        Only the columns above and the geometry are read for the map. The fields we aggregate are JSON
+#        properties in the data, so the models have typed columns generated from the JSON for them, see
+#        models.json_field. Add one there, and an index in __indexed__ if needed, before using a new field.
+#   'columns': (optional) Other columns of the model the export may plot instead of column, with their names.
 # }
+# The datasets are imported in this order.
 
 DATASETS = {
     'osm': {
         'label': 'OpenStreetMap amenities',
+        'importer': 'scripts.import_osm.OsmImporter',
+        'memory': 2,
         'model': OSMPoint,
         'name': 'Number of amenities',
         'weight': 1
     },
     'flickr': {
         'label': 'Flickr photographers',
+        'importer': 'scripts.import_flickr.FlickrImporter',
+        'memory': 1,
         'model': FlickrPoint,
         'name': 'Number of photographers',
-        'group_by': 'properties.owner',
+        'group_by': 'owner',
         'weight': 1
     },
     'gtfs': {
         'label': 'GTFS departures',
+        'importer': 'scripts.import_gtfs.GTFSImporter',
+        'memory': 2,
         'model': GTFSStop,
         'name': 'Transit departures per day',
         'plot': 'sum',
-        'column': 'properties.ntrips',
+        'column': 'ntrips',
+        'columns': {
+            'ntrips_weekday': 'Transit departures per weekday',
+            'ntrips_weekday_morning': 'Transit departures on weekday mornings 7-9',
+            'ntrips_weekday_evening': 'Transit departures on weekday evenings 16-18',
+            'ntrips_weekend': 'Transit departures per weekend day',
+            'ntrips_weekend_morning': 'Transit departures on weekend mornings 7-9',
+            'ntrips_weekend_evening': 'Transit departures on weekend evenings 16-18',
+        },
         'weight': 1
     },
     'access': {
         'label': 'OpenStreetMap walking times',
+        'importer': 'scripts.import_osm_accessibility.AccessibilityImporter',
+        # The accessibility importer is a beast. Creating and routing thru the graph requires
+        # several gigabytes of memory, depending on the size of your city.
+        'memory': 6,
         'model': OSMAccessNode,
         'name': 'Walking times to five amenities',
         'plot': 'mean',
-        'column': 'accessibilities.5',
+        'column': 'access_5',
         'weight': -1
     },
     'ookla': {
         'label': 'Ookla Internet device numbers',
+        'importer': 'scripts.import_ookla.OoklaImporter',
+        # streamed to the database, memory use doesn't depend on city size. Partitioning
+        # the global data on the first import reads all of it.
+        'memory': 2,
+        'prepare_memory': 4,
         'model': OoklaPoint,
         'name': 'Internet device numbers',
         'plot': 'sum',
-        'column': 'properties.devices',
+        'column': 'devices',
         'weight': 1
     },
     'kontur': {
         'label': 'Kontur population density',
+        'importer': 'scripts.import_kontur.KonturImporter',
+        # streamed to the database, memory use doesn't depend on city size. Partitioning
+        # the global data on the first import reads all of it.
+        'memory': 2,
+        'prepare_memory': 4,
         'model': KonturPoint,
         'name': 'Population density',
         'plot': 'sum',
-        'column': 'properties.population',
+        'column': 'population',
         'weight': 1
     }
 }
+
+
+def get_importer(dataset: str) -> type:
+    """Loads and returns the importer class of the dataset."""
+    module_name, class_name = DATASETS[dataset]['importer'].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def get_column(dataset: str, column: Optional[str] = None) -> Optional[str]:
+    """Returns the column to plot, checking that the dataset has it. By default, the column of the dataset."""
+    if not column:
+        return DATASETS[dataset].get('column')
+    if column != DATASETS[dataset].get('column') and column not in DATASETS[dataset].get('columns', {}):
+        raise AssertionError(f"Dataset {dataset} has no column {column} to plot.")
+    return column
+
+
+def get_columns(dataset: str, column: Optional[str] = None) -> list:
+    """Returns the columns of the dataset model needed for the map, plotting the column given."""
+    model = DATASETS[dataset]['model']
+    names = [get_column(dataset, column), DATASETS[dataset].get('group_by')]
+    return [model.geom] + [getattr(model, name) for name in names if name]
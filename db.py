@@ -0,0 +1,40 @@
+import os
+from typing import Dict, Tuple
+
+from dotenv import load_dotenv
+from ipygis import get_connection_url
+from sqlalchemy import create_engine
+from sqlalchemy.engine.base import Engine
+
+load_dotenv()
+# Connections kept open per process, and the extra connections allowed at peak.
+# With concurrent imports, keep (workers * (pool size + overflow)) below max_connections.
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 5))
+
+# engines by process id and database. Forked processes must never share pooled connections.
+_engines: Dict[Tuple[int, str], Engine] = {}
+
+
+def get_engine(dbname: str = "geoviz") -> Engine:
+    """Returns the shared engine and connection pool of this process for the database."""
+    key = (os.getpid(), dbname)
+    if key not in _engines:
+        _engines[key] = create_engine(
+            get_connection_url(dbname=dbname),
+            pool_size=POOL_SIZE,
+            max_overflow=MAX_OVERFLOW,
+            # workers live long, the database may have restarted in between
+            pool_pre_ping=True,
+        )
+    return _engines[key]
+
+
+def with_schema(engine: Engine, slug: str) -> Engine:
+    """Returns the engine with tables in the "schema" schema mapped to the schema of the city.
+
+    The returned engine shares the connection pool of the original engine.
+    """
+    # TODO: prevent injection by schema slug. just
+    # check if schema exists (e.g. public) and crash
+    return engine.execution_options(schema_translate_map={"schema": slug})
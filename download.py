@@ -0,0 +1,202 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from logging import Logger
+from typing import Dict, Optional
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+# Number of files to download at the same time
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 4))
+# Bytes to write at a time
+CHUNK_SIZE = 1024 * 1024
+# Don't let a stalled server stall the import
+TIMEOUT = 60
+# S3 ETags of files uploaded in one part are the MD5 of the file
+MD5_ETAG = re.compile("[0-9a-f]{32}")
+
+
+def download(url: str, path: str, logger: Logger) -> int:
+    """Downloads the url to the path, unless we have it already, and returns the number of bytes downloaded.
+
+    The file is written to path.part first, so a crashed download is resumed where it
+    stopped, if the file on the server hasn't changed since. The size of the file, and
+    its MD5 checksum if the ETag is one, are checked before moving the file to the path.
+    The ETag and size are saved in path.json. Processes sharing the file wait for each
+    other, so the file is only downloaded once.
+
+    Use this for files that never change. For files that may, use refresh instead.
+    """
+    # other processes may be downloading the same file
+    with locked(path):
+        return _download(url, path, logger)
+
+
+def refresh(url: str, path: str, logger: Logger) -> int:
+    """Downloads the url to the path, unless the file has not changed since the last download.
+
+    Returns the number of bytes downloaded. The ETag and Last-Modified of the last
+    download are sent with the request, so the server only sends the file if it has
+    changed. Otherwise, the saved file is used. The file is checked as in download,
+    and replaced only once the new one is complete, so concurrent imports may use it.
+    """
+    headers = {}
+    if os.path.isfile(path):
+        metadata = read_metadata(path)
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+    # other processes may be downloading the same file
+    partial_path = f"{path}.{os.getpid()}.part"
+    with requests.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        if response.status_code == 304:
+            logger.info(f"{url} has not changed, using saved {os.path.basename(path)}...")
+            return 0
+        logger.info(f"Downloading {url}...")
+        # the size of compressed content is not the size of the file
+        encoded = "Content-Encoding" in response.headers
+        size = None if encoded else int(response.headers.get("Content-Length", 0)) or None
+        etag = response.headers.get("ETag", "")
+        last_modified = response.headers.get("Last-Modified")
+        try:
+            downloaded = _write(response, partial_path)
+        except BaseException:
+            os.remove(partial_path)
+            raise
+
+    _finish(url, partial_path, path, size, etag)
+    save_metadata(path, {"url": url, "etag": etag, "last_modified": last_modified, "size": size})
+    logger.info(f"Downloaded {os.path.basename(path)}")
+    return downloaded
+
+
+def version(url: str, path: str, logger: Logger) -> Optional[str]:
+    """Returns the ETag or Last-Modified of the file at the url, without downloading it.
+
+    If the server can't be reached, the version of the file saved at the path is
+    returned, as refresh would use the saved file too.
+    """
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=TIMEOUT)
+        response.raise_for_status()
+        if response.headers.get("ETag") or response.headers.get("Last-Modified"):
+            return response.headers.get("ETag") or response.headers.get("Last-Modified")
+    except requests.RequestException as e:
+        logger.warning(f"Could not check {url} for a newer version: {e}")
+    metadata = read_metadata(path)
+    return metadata.get("etag") or metadata.get("last_modified")
+
+
+def download_all(downloads: Dict[str, str], logger: Logger) -> int:
+    """Downloads the urls to their paths as in download, DOWNLOAD_WORKERS at a time.
+
+    Returns the number of bytes downloaded.
+    """
+    if not downloads:
+        return 0
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = [executor.submit(download, url, path, logger) for url, path in downloads.items()]
+        return sum(future.result() for future in futures)
+
+
+@contextmanager
+def locked(path: str):
+    """Holds an exclusive lock on the path, waiting for other processes holding it.
+
+    Use this around anything writing shared files in the data directory, e.g.
+    downloading or extracting them.
+    """
+    with open(f"{path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_metadata(path: str) -> Dict:
+    """Returns the metadata saved for the downloaded file, e.g. its ETag."""
+    try:
+        with open(f"{path}.json") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_metadata(path: str, metadata: Dict):
+    with open(f"{path}.json", "w") as file:
+        json.dump(metadata, file)
+
+
+def _download(url: str, path: str, logger: Logger) -> int:
+    # downloads the file, the caller holds the lock of the path
+    if os.path.isfile(path):
+        logger.info(f"Found saved {os.path.basename(path)}...")
+        return 0
+    partial_path = f"{path}.part"
+    with requests.head(url, allow_redirects=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        size = int(response.headers.get("Content-Length", 0)) or None
+        etag = response.headers.get("ETag", "")
+    if os.path.isfile(partial_path) and read_metadata(path).get("etag") != etag:
+        # the partial file is of an older version of the data
+        os.remove(partial_path)
+    save_metadata(path, {"url": url, "etag": etag, "size": size})
+
+    offset = os.path.getsize(partial_path) if os.path.isfile(partial_path) else 0
+    downloaded = 0
+    if size is None or offset < size:
+        logger.info(f"Downloading {url}" + (f" from byte {offset}..." if offset else "..."))
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with requests.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                # the server doesn't do ranges, start over
+                offset = 0
+            downloaded = _write(response, partial_path, append=bool(offset))
+
+    _finish(url, partial_path, path, size, etag)
+    logger.info(f"Downloaded {os.path.basename(path)}")
+    return downloaded
+
+
+def _write(response: requests.Response, path: str, append: bool = False) -> int:
+    # streams the response to the file, and returns the number of bytes written
+    written = 0
+    with open(path, "ab" if append else "wb") as file:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            file.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def _finish(url: str, partial_path: str, path: str, size: Optional[int], etag: str):
+    # moves the downloaded file to its path, if it is complete
+    error = _check(partial_path, size, etag)
+    if error:
+        os.remove(partial_path)
+        raise RuntimeError(f"Download of {url} failed: {error}")
+    os.replace(partial_path, path)
+
+
+def _check(path: str, size: Optional[int], etag: str) -> Optional[str]:
+    # returns what is wrong with the file, if anything
+    if size is not None and os.path.getsize(path) != size:
+        return f"expected {size} bytes, got {os.path.getsize(path)}"
+    etag = etag.strip('"')
+    if MD5_ETAG.fullmatch(etag):
+        md5 = hashlib.md5()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                md5.update(chunk)
+        if md5.hexdigest() != etag:
+            return "checksum does not match"
+    return None
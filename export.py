@@ -2,90 +2,129 @@
 
 import argparse
 import os
-from datasets import DATASETS
-from ipygis import get_connection_url, QueryResult, generate_map
+from datasets import DATASETS, get_column, get_columns
+from ipygis import QueryResult, generate_map
+from logging import Logger
 from slugify import slugify
-from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy.engine.base import Engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.schema import DropSchema
+from typing import Dict, List, Optional
 from notebooks.kepler_h3_config import config  # we may use our own custom visualization config
-from osm_tags import tag_filter
+from osm_tags import reclassify, tag_filter
 
+from db import get_engine, with_schema
+from models import OoklaPoint
 from util import create_logger
 
 MAPS_PATH = "server/maps"
 
-parser = argparse.ArgumentParser(description="Create result map for a given city")
-parser.add_argument("city_slug", default="helsinki", help="Slug of city to import")
-parser.add_argument("--datasets",
-                    default=" ".join([dataset for dataset in DATASETS]),
-                    help="Datasets to include in analysis. Default is to use all imported data. E.g. \"osm access kontur\""
-                    )
-parser.add_argument("--delete",
-                    action="store_true",
-                    default=False,
-                    help="Delete imported data from the database when the visualization is finished. Default is False."
-                         " The result map is independent from the analysis database, so you may save a lot of disk space"
-                         " by deleting the data if you don't expect to create the map again.")
-args = vars(parser.parse_args())
 
-# slugify city name just in case export was called with non-slug
-slug = slugify(args["city_slug"])
-datasets_to_export = args["datasets"].split()
-delete = args.get("delete", False)
+def run_export(slug: str,
+               datasets_to_export: List[str],
+               delete: bool = False,
+               engine: Optional[Engine] = None,
+               logger: Optional[Logger] = None,
+               columns: Optional[Dict[str, str]] = None) -> str:
+    """Creates the result map for the city and returns the path of the map file.
 
-# log each city separately
-logger = create_logger(slug)
+    Pass the logger of the import run to log the export in the same file. By
+    default, the shared connection pool of the process is used. Pass columns
+    to plot other columns of the datasets than the default ones, e.g.
+    {'gtfs': 'ntrips_weekday_morning'}.
+    """
+    if not logger:
+        # log each city separately
+        logger = create_logger(slug)
+    if not engine:
+        engine = get_engine()
+    schema_engine = with_schema(engine, slug)
+    session = sessionmaker(bind=schema_engine)()
 
-sql_url = get_connection_url(dbname='geoviz')
-engine = create_engine(sql_url)
-schema_engine = engine.execution_options(
-    schema_translate_map={'schema': slug}
-)
-session = sessionmaker(bind=schema_engine)()
+    logger.info(f"Collecting results for {slug} with {datasets_to_export}...")
 
-logger.info(f"Collecting results for {slug} with {datasets_to_export}...")
+    # the columns are typed, so plotting another one doesn't need the data imported again
+    plot_columns = {
+        dataset: get_column(dataset, (columns or {}).get(dataset))
+        for dataset in datasets_to_export
+    }
+    names = {
+        dataset: DATASETS[dataset].get('columns', {}).get(plot_columns[dataset], DATASETS[dataset]['name'])
+        for dataset in datasets_to_export
+    }
+    queries = {
+        dataset: session.query(*get_columns(dataset, plot_columns[dataset]))
+        for dataset in datasets_to_export
+    }
+    # osm query requires special filtering if we have extra nodes in the db
+    if 'osm' in queries:
+        reclassify(schema_engine, logger)
+        queries['osm'] = queries['osm'].filter(tag_filter)
+    # ookla may have many quarters, the map shows the latest one
+    if 'ookla' in queries:
+        latest = session.query(func.max(OoklaPoint.quarter)).scalar_subquery()
+        queries['ookla'] = queries['ookla'].filter(OoklaPoint.quarter == latest)
 
-queries = {
-    dataset: session.query(DATASETS[dataset]['model'])
-    for dataset in datasets_to_export
-}
-# osm query requires special filtering if we have extra nodes in the db
-if 'osm' in queries:
-    queries['osm'] = queries['osm'].filter(tag_filter)
+    logger.info(f"Running queries for {slug} with {datasets_to_export}...")
+    results = [
+        QueryResult.create(
+            query,
+            resolution=8,
+            name=names[dataset],
+            plot=DATASETS[dataset].get('plot', 'size'),
+            group_by=DATASETS[dataset].get('group_by', None),
+            column=plot_columns[dataset]
+        )
+        for dataset, query in queries.items()
+    ]
+    session.close()
 
-logger.info(f"Running queries for {slug} with {datasets_to_export}...")
-results = [
-    QueryResult.create(
-        query,
-        resolution=8,
-        name=DATASETS[dataset]['name'],
-        plot=DATASETS[dataset].get('plot', 'size'),
-        group_by=DATASETS[dataset].get('group_by', None),
-        column=DATASETS[dataset].get('column', None)
-    )
-    for dataset, query in queries.items()
-]
+    logger.info(f"Creating map for {slug} with {datasets_to_export}...")
+    weights = [
+        DATASETS[dataset]['weight']
+        for dataset in datasets_to_export
+    ]
+    plotted = [
+        plot_columns[dataset] or 'size'
+        for dataset in datasets_to_export
+    ]
 
-logger.info(f"Creating map for {slug} with {datasets_to_export}...")
-weights = [
-    DATASETS[dataset]['weight']
-    for dataset in datasets_to_export
-]
-columns = [
-    DATASETS[dataset].get('column', 'size').split('.')[-1]
-    for dataset in datasets_to_export
-]
+    result_map = generate_map(results, 500, config=config, column=plotted, weights=weights, clusters=0.005)
+    map_path = os.path.join(os.path.dirname(__loader__.path), MAPS_PATH)
+    if not os.path.exists(map_path):
+        os.mkdir(map_path)
+    filename = os.path.join(map_path, f"{slug}.html")
+    result_map.save_to_html(file_name=filename)
+    # delete interim database at the end, we have all the data we need on the map
+    if delete:
+        logger.info(f"Deleting analysis database for {slug}...")
+        engine.execute(DropSchema(slug, cascade=True))
 
-result_map = generate_map(results, 500, config=config, column=columns, weights=weights, clusters=0.005)
-map_path = os.path.join(os.path.dirname(__loader__.path), MAPS_PATH)
-if not os.path.exists(map_path):
-    os.mkdir(map_path)
-filename = os.path.join(map_path, f"{slug}.html")
-result_map.save_to_html(file_name=filename)
-# delete interim database at the end, we have all the data we need on the map
-if delete:
-    logger.info(f"Deleting analysis database for {slug}...")
-    engine.execute(DropSchema(slug, cascade=True))
+    logger.info(f"--- Datasets {datasets_to_export} for {slug} exported to Kepler.gl ---")
+    return filename
 
-logger.info(f"--- Datasets {datasets_to_export} for {slug} exported to Kepler.gl ---")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create result map for a given city")
+    parser.add_argument("city_slug", default="helsinki", help="Slug of city to import")
+    parser.add_argument("--datasets",
+                        default=" ".join([dataset for dataset in DATASETS]),
+                        help="Datasets to include in analysis. Default is to use all imported data. E.g. \"osm access kontur\""
+                        )
+    parser.add_argument("--delete",
+                        action="store_true",
+                        default=False,
+                        help="Delete imported data from the database when the visualization is finished. Default is False."
+                             " The result map is independent from the analysis database, so you may save a lot of disk space"
+                             " by deleting the data if you don't expect to create the map again.")
+    parser.add_argument("--columns",
+                        default="",
+                        help="Columns to plot instead of the default ones, as dataset=column. E.g."
+                             " \"gtfs=ntrips_weekday_morning\" to plot transit departures on weekday mornings."
+                             " See DATASETS in datasets.py for the columns of each dataset.")
+    args = vars(parser.parse_args())
+    arg_columns = dict(column.split("=", 1) for column in args["columns"].split())
+
+    # slugify city name just in case export was called with non-slug
+    run_export(slugify(args["city_slug"]), args["datasets"].split(), args.get("delete", False), columns=arg_columns)
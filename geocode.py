@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import datetime
+import gzip
+import os
+import unicodedata
+from logging import Logger
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from dotenv import load_dotenv
+from geoalchemy2.shape import from_shape, to_shape
+from shapely.geometry import Point, box
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine.base import Engine
+from sqlalchemy.orm import sessionmaker
+
+from db import get_engine
+from models import GeocodedCity
+from util import create_logger
+
+load_dotenv()
+osmnames_url = os.getenv("OSMNAMES_URL")
+# Cities don't move, but their boundaries are edited every now and then
+CACHE_TTL_DAYS = float(os.getenv("GEOCODE_CACHE_TTL_DAYS", 90))
+# Don't let a flaky geocoder stall the import
+TIMEOUT = 30
+# Rows to upsert at a time when prewarming the cache
+BATCH_SIZE = 10000
+# OSMNames dump rows that may be imported as cities
+PLACE_CLASSES = {"place", "boundary"}
+
+
+def normalize(city: str) -> str:
+    """Returns the cache key for the city name, e.g. "  new   York " -> "new york"."""
+    return " ".join(unicodedata.normalize("NFKC", city).casefold().split())
+
+
+def read_places(path: str, country_codes: Optional[List[str]] = None) -> Dict[str, Tuple]:
+    """Returns the most important place by each name in an OSMNames dump.
+
+    The places are returned by their cache key, as (importance, name, bbox,
+    centroid, country). Only the fields cached are kept, the planet dump has
+    millions of places.
+    """
+    country_codes = {code.lower() for code in country_codes or []}
+    places = {}
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as dump:
+        # names may contain quotes, the dump is not quoted
+        for row in csv.DictReader(dump, delimiter="\t", quoting=csv.QUOTE_NONE):
+            if row["class"] not in PLACE_CLASSES or not row["name"]:
+                continue
+            if country_codes and row["country_code"] not in country_codes:
+                continue
+            key = normalize(row["name"])
+            importance = float(row["importance"] or 0)
+            if key not in places or importance > places[key][0]:
+                places[key] = (
+                    importance,
+                    row["name"],
+                    tuple(float(row[coord]) for coord in ("west", "south", "east", "north")),
+                    (float(row["lon"]), float(row["lat"])),
+                    row["country"],
+                )
+    return places
+
+
+class Geocoder(object):
+    """Finds the bounding box of a city, asking OSMNames or Nominatim only if
+    the city is not found in the geocode cache already.
+    """
+
+    def __init__(self, engine: Engine, logger: Logger, ttl_days: Optional[float] = None):
+        self.logger = logger
+        self.ttl = datetime.timedelta(days=CACHE_TTL_DAYS if ttl_days is None else ttl_days)
+        GeocodedCity.__table__.create(engine, checkfirst=True)
+        self.session = sessionmaker(bind=engine)()
+
+    def geocode(self, city: str) -> List[float]:
+        """Returns the bbox of the city as minx, miny, maxx, maxy."""
+        key = normalize(city)
+        self.evict()
+        cached = self.session.query(GeocodedCity).filter(GeocodedCity.key == key).first()
+        if cached:
+            self.logger.info(f"Found {city} in geocode cache, geocoded by {cached.source} at {cached.updated}")
+            return list(to_shape(cached.bbox).bounds)
+        result = self._fetch(city)
+        self._store([dict(result, key=key, name=city)])
+        return result["bbox"]
+
+    def evict(self) -> int:
+        """Deletes cached cities older than the ttl. Returns the number of cities deleted."""
+        expired = datetime.datetime.now() - self.ttl
+        count = self.session.query(GeocodedCity).filter(GeocodedCity.updated < expired).delete()
+        self.session.commit()
+        if count:
+            self.logger.info(f"Evicted {count} cities from geocode cache")
+        return count
+
+    def prewarm(self, path: str, country_codes: Optional[List[str]] = None) -> int:
+        """Fills the cache from an OSMNames dump, e.g. planet-latest_geonames.tsv.gz.
+
+        If the dump has several places by the same name, the most important one
+        is cached, as that's what the OSMNames search would return first.
+        Returns the number of cities cached.
+        """
+        self.logger.info(f"Reading places from {path}...")
+        places = read_places(path, country_codes)
+        self.logger.info(f"Caching {len(places)} places...")
+        batch = []
+        for key, (_, name, bbox, centroid, country) in places.items():
+            batch.append({
+                "key": key,
+                "name": name,
+                "bbox": bbox,
+                "centroid": centroid,
+                "country": country,
+                "source": os.path.basename(path),
+            })
+            if len(batch) >= BATCH_SIZE:
+                self._store(batch)
+                batch = []
+        self._store(batch)
+        return len(places)
+
+    def _fetch(self, city: str) -> Dict:
+        if osmnames_url:
+            # Use our own geocoding service. It provides bbox and country for city.
+            self.logger.info(f"Geocoding {city} using OSMNames service at {osmnames_url}...")
+            try:
+                city_data = requests.get(f"{osmnames_url}/q/{city}.js", timeout=TIMEOUT).json()["results"][0]
+                return {
+                    "bbox": [float(coord) for coord in city_data["boundingbox"]],
+                    "centroid": [float(city_data["lon"]), float(city_data["lat"])],
+                    "country": city_data.get("country"),
+                    "source": "osmnames",
+                }
+            except (requests.RequestException, ValueError, KeyError, IndexError) as error:
+                self.logger.warning(f"OSMNames failed to geocode {city}: {error!r}")
+        # Fall back to Nominatim. Their API doesn't always respond tho.
+        # Get bbox, centroid and country for the city
+        self.logger.info(f"Geocoding {city} using Nominatim...")
+        city_params = {"q": city, "limit": 1, "format": "json", "addressdetails": 1}
+        city_data = requests.get(
+            "https://nominatim.openstreetmap.org/search", params=city_params, timeout=TIMEOUT
+        ).json()[0]
+        centroid = [float(city_data["lon"]), float(city_data["lat"])]
+        self.logger.info(f"{city} centroid: {centroid}")
+        return {
+            # nominatim returns miny, maxy, minx, maxx
+            # we want minx, miny, maxx, maxy
+            "bbox": [float(city_data["boundingbox"][i]) for i in [2, 0, 3, 1]],
+            "centroid": centroid,
+            "country": city_data.get("address", {}).get("country"),
+            "source": "nominatim",
+        }
+
+    def _store(self, results: List[Dict]):
+        if not results:
+            return
+        now = datetime.datetime.now()
+        rows = [{
+            "key": result["key"],
+            "name": result["name"],
+            "bbox": from_shape(box(*result["bbox"]), srid=4326),
+            "centroid": from_shape(Point(*result["centroid"]), srid=4326),
+            "country": result["country"],
+            "source": result["source"],
+            "updated": now,
+        } for result in results]
+        statement = insert(GeocodedCity.__table__).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=["key"],
+            set_={column: statement.excluded[column] for column in
+                  ("name", "bbox", "centroid", "country", "source", "updated")}
+        )
+        self.session.execute(statement)
+        self.session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Geocode cities, or manage the geocode cache")
+    parser.add_argument("city", nargs="?", help="City to geocode")
+    parser.add_argument("--prewarm",
+                        help="Fill the cache from an OSMNames dump, e.g. planet-latest_geonames.tsv.gz")
+    parser.add_argument("--countries",
+                        help="Only cache places in these countries when prewarming. E.g. \"fi se no\"")
+    parser.add_argument("--evict",
+                        action="store_true",
+                        default=False,
+                        help="Delete expired cities from the cache.")
+    args = vars(parser.parse_args())
+    if not (args["city"] or args["prewarm"] or args["evict"]):
+        parser.error("Give a city to geocode, --prewarm or --evict")
+
+    logger = create_logger("geocode")
+    geocoder = Geocoder(get_engine(), logger)
+    if args["evict"]:
+        geocoder.evict()
+    if args["prewarm"]:
+        countries = args["countries"].split() if args["countries"] else None
+        count = geocoder.prewarm(args["prewarm"], countries)
+        logger.info(f"Cached {count} places from {args['prewarm']}")
+    if args["city"]:
+        print(" ".join(str(coord) for coord in geocoder.geocode(args["city"])))
@@ -0,0 +1,179 @@
+import csv
+import io
+import zipfile
+from logging import Logger
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from shapely.geometry import Point
+
+# Rows to read from stop_times.txt at a time. National feeds have hundreds of
+# millions of stop times, so the file is never read at once.
+CHUNK_ROWS = 1000000
+# calendar.txt columns, in the order of pandas weekdays
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+# Kinds of days to count departures on, as pandas weekdays
+DAYS = {
+    "busiest": [0, 1, 2, 3, 4, 5, 6],
+    "weekday": [0, 1, 2, 3, 4],
+    "weekend": [5, 6],
+}
+# Departures are counted per stop in these columns, as the kind of day and the
+# hours of the day. Each column is a typed column of GTFSStop.
+FREQUENCIES = {
+    "ntrips": ("busiest", (0, 24)),
+    "ntrips_weekday": ("weekday", (0, 24)),
+    "ntrips_weekday_morning": ("weekday", (7, 9)),
+    "ntrips_weekday_evening": ("weekday", (16, 18)),
+    "ntrips_weekend": ("weekend", (0, 24)),
+    "ntrips_weekend_morning": ("weekend", (7, 9)),
+    "ntrips_weekend_evening": ("weekend", (16, 18)),
+}
+
+
+def read_feed(path: str, bbox: Optional[List[float]], logger: Logger) -> Tuple[DataFrame, DataFrame, DataFrame]:
+    """Reads the stops within the bbox, their stop times and the dates their trips run.
+
+    Only the stops inside the bbox are read from stops.txt, and stop_times.txt is streamed
+    keeping the stop times of those stops only, so memory use depends on the size of the city,
+    not the feed. Shapes and routes are not read at all.
+
+    Returns the stops, with stop_id, stop_name and geometry, their stop times, with trip_id,
+    stop_id, departure_time in seconds and service_id, and the service_id and date of each
+    day the services of the stop times run.
+    """
+    with zipfile.ZipFile(path) as feed:
+        # some feeds have their files in a directory
+        members = {name.rsplit("/", 1)[-1]: name for name in feed.namelist()}
+
+        stops = _read(feed, members, "stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon"])
+        xs = pd.to_numeric(stops["stop_lon"], errors="coerce").to_numpy()
+        ys = pd.to_numeric(stops["stop_lat"], errors="coerce").to_numpy()
+        if bbox:
+            minx, miny, maxx, maxy = bbox
+            in_bbox = (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)
+            stops, xs, ys = stops[in_bbox], xs[in_bbox], ys[in_bbox]
+        stops = DataFrame({
+            "stop_id": stops["stop_id"].to_numpy(),
+            "stop_name": stops["stop_name"].to_numpy(),
+            "geometry": [Point(x, y) for x, y in zip(xs, ys)]
+        })
+        logger.info(f"Found {len(stops)} GTFS stops in bbox, reading their stop times...")
+
+        stop_ids = set(stops["stop_id"])
+        chunks = []
+        rows_read = 0
+        for chunk in _read_chunks(feed, members, "stop_times.txt",
+                                  ["trip_id", "stop_id", "arrival_time", "departure_time"]):
+            rows_read += len(chunk)
+            chunks.append(chunk[chunk["stop_id"].isin(stop_ids)])
+        stop_times = pd.concat(chunks, ignore_index=True)
+        logger.info(f"Kept {len(stop_times)} of {rows_read} GTFS stop times")
+        # only timepoints must have times, the rest may only have one of them
+        stop_times["departure_time"] = seconds(stop_times["departure_time"].fillna(stop_times["arrival_time"]))
+        stop_times = stop_times.drop(columns="arrival_time")
+
+        trips = _read(feed, members, "trips.txt", ["trip_id", "service_id"])
+        trips = trips[trips["trip_id"].isin(set(stop_times["trip_id"]))]
+        dates = service_dates(
+            _read(feed, members, "calendar.txt", ["service_id", *WEEKDAYS, "start_date", "end_date"]),
+            _read(feed, members, "calendar_dates.txt", ["service_id", "date", "exception_type"])
+        )
+
+    dates = dates[dates["service_id"].isin(set(trips["service_id"]))].reset_index(drop=True)
+    return stops, stop_times.merge(trips, on="trip_id"), dates
+
+
+def frequencies(stops: DataFrame, stop_times: DataFrame, dates: DataFrame, logger: Logger) -> DataFrame:
+    """Returns the stops with the number of departures in each column of FREQUENCIES.
+
+    The departures on each kind of day are counted on the day of that kind with the most
+    trips, e.g. on the busiest weekday of the feed. Departures after midnight count on the
+    hour after midnight of the same day, so a day always has 24 hours. Stops without any
+    departures are left out.
+    """
+    trips_per_date = dates.merge(stop_times.drop_duplicates("trip_id").groupby("service_id").size()
+                                 .rename("trips").reset_index())
+    trips_per_date = trips_per_date.groupby("date")["trips"].sum()
+    weekdays = trips_per_date.index.weekday
+    # which services run on the busiest day of each kind
+    services = DataFrame(index=pd.Index(dates["service_id"].unique(), name="service_id"))
+    for day, day_weekdays in DAYS.items():
+        candidates = trips_per_date[np.isin(weekdays, day_weekdays)]
+        if candidates.empty:
+            services[day] = False
+            continue
+        busiest = candidates.idxmax()
+        logger.info(f"Counting GTFS departures on {busiest.date()} for {day}")
+        services[day] = services.index.isin(dates.loc[dates["date"] == busiest, "service_id"])
+
+    # one pass over the stop times, summing a flag per column
+    runs = services.reindex(stop_times["service_id"], fill_value=False)
+    hours = stop_times["departure_time"].to_numpy() / 3600 % 24
+    flags = {
+        column: runs[day].to_numpy() & (hours >= start) & (hours < end)
+        for column, (day, (start, end)) in FREQUENCIES.items()
+    }
+    counts = DataFrame(flags).groupby(stop_times["stop_id"].to_numpy()).sum()
+    counts = counts[counts.any(axis=1)].rename_axis("stop_id").reset_index()
+    return stops.merge(counts, on="stop_id")
+
+
+def service_dates(calendar: DataFrame, calendar_dates: DataFrame) -> DataFrame:
+    """Returns the service_id and date of each day a service runs."""
+    calendar = calendar.dropna(subset=["start_date", "end_date"])
+    start_dates = pd.to_datetime(calendar["start_date"], format="%Y%m%d")
+    days = (pd.to_datetime(calendar["end_date"], format="%Y%m%d") - start_dates).dt.days.clip(lower=-1) + 1
+    # one row per day from start to end date
+    rows = np.repeat(np.arange(len(calendar)), days.to_numpy())
+    offsets = np.arange(len(rows)) - np.repeat(days.cumsum().to_numpy() - days.to_numpy(), days.to_numpy())
+    dates = start_dates.to_numpy()[rows] + offsets.astype("timedelta64[D]")
+    runs = calendar[WEEKDAYS].to_numpy()[rows, pd.DatetimeIndex(dates).weekday] == "1"
+    dates = DataFrame({"service_id": calendar["service_id"].to_numpy()[rows][runs], "date": dates[runs]})
+
+    # exception type 1 adds the date, 2 removes it
+    exceptions = DataFrame({
+        "service_id": calendar_dates["service_id"],
+        "date": pd.to_datetime(calendar_dates["date"], format="%Y%m%d"),
+        "added": calendar_dates["exception_type"].str.strip() == "1"
+    })
+    removed = exceptions.loc[~exceptions["added"], ["service_id", "date"]]
+    dates = dates.merge(removed, how="left", indicator=True)
+    dates = dates.loc[dates["_merge"] == "left_only", ["service_id", "date"]]
+    added = exceptions.loc[exceptions["added"], ["service_id", "date"]]
+    return pd.concat([dates, added], ignore_index=True).drop_duplicates(ignore_index=True)
+
+
+def seconds(times: pd.Series) -> pd.Series:
+    """Returns the GTFS times, e.g. 25:10:00, as seconds since the start of the service day."""
+    parts = times.str.split(":", expand=True)
+    if parts.shape[1] != 3:
+        return pd.Series(np.nan, index=times.index)
+    hours, minutes, secs = (pd.to_numeric(parts[i], errors="coerce") for i in range(3))
+    return hours * 3600 + minutes * 60 + secs
+
+
+def _read(feed: zipfile.ZipFile, members: Dict[str, str], filename: str, columns: List[str]) -> DataFrame:
+    # reads the columns of the file as strings, a missing file or column is empty
+    return pd.concat(_read_chunks(feed, members, filename, columns), ignore_index=True)
+
+
+def _read_chunks(feed: zipfile.ZipFile, members: Dict[str, str], filename: str,
+                 columns: List[str]) -> Iterator[DataFrame]:
+    if filename not in members:
+        yield DataFrame(columns=columns, dtype=str)
+        return
+    with feed.open(members[filename]) as file:
+        text = io.TextIOWrapper(file, encoding="utf-8-sig")
+        # some feeds have spaces in the header
+        header = [column.strip() for column in next(csv.reader([text.readline()]), [])]
+        chunks = pd.read_csv(text, header=None, names=header, usecols=[column for column in columns if column in header],
+                             dtype=str, chunksize=CHUNK_ROWS)
+        empty = True
+        for chunk in chunks:
+            empty = False
+            yield chunk.reindex(columns=columns)
+    if empty:
+        yield DataFrame(columns=columns, dtype=str)
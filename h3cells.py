@@ -0,0 +1,89 @@
+import os
+from functools import lru_cache
+from typing import List, Set, Tuple, Union
+
+import numpy as np
+from dotenv import load_dotenv
+from h3 import LatLngPoly
+from h3.api import basic_int
+from pyproj import Transformer
+from sqlalchemy.sql.elements import ColumnElement
+
+load_dotenv()
+# Resolution of the h3_cell column in all imported tables. Cells at coarser
+# resolutions are cheap to get from it, see parent.
+H3_RESOLUTION = int(os.getenv("H3_RESOLUTION", 8))
+
+# H3 index bits, see https://h3geo.org/docs/core-library/h3Indexing
+RESOLUTION_OFFSET = 52
+DIGIT_BITS = 3
+MAX_RESOLUTION = 15
+
+
+def cells(xs: np.ndarray, ys: np.ndarray, srid: int = 4326, resolution: int = H3_RESOLUTION) -> np.ndarray:
+    """Returns the H3 cells of the points as int64.
+
+    The points are projected in one call, but h3 has no array API, so each
+    point is hashed by its own h3 call.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    if srid != 4326:
+        xs, ys = _transformer(srid).transform(xs, ys)
+    return np.fromiter(
+        (basic_int.latlng_to_cell(y, x, resolution) for x, y in zip(xs.tolist(), ys.tolist())),
+        dtype=np.int64, count=len(xs)
+    )
+
+
+def covering(bbox: List[float], resolution: int) -> Set[int]:
+    """Returns the cells at the resolution covering the bbox (minx, miny, maxx, maxy) in EPSG:4326.
+
+    The cells around the bbox are included, too, since the children of a cell
+    stick out of it a little.
+    """
+    minx, miny, maxx, maxy = bbox
+    polygon = LatLngPoly([(miny, minx), (miny, maxx), (maxy, maxx), (maxy, minx)])
+    # cells with centroids in the bbox, and the cells of the corners if the bbox is smaller than a cell
+    inside = set(basic_int.h3shape_to_cells(polygon, resolution))
+    corners = {basic_int.latlng_to_cell(y, x, resolution) for x in (minx, maxx) for y in (miny, maxy)}
+    return set().union(*(basic_int.grid_disk(cell, 1) for cell in inside | corners))
+
+
+def centroids(cells: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the x and y coordinates of the centers of the cells in EPSG:4326."""
+    # no polygons are needed, the center is one h3 call per cell
+    coordinates = np.array([basic_int.cell_to_latlng(cell) for cell in np.asarray(cells).tolist()],
+                           dtype=np.float64).reshape(-1, 2)
+    return coordinates[:, 1], coordinates[:, 0]
+
+
+@lru_cache()
+def _transformer(srid: int) -> Transformer:
+    return Transformer.from_crs(srid, 4326, always_xy=True)
+
+
+def _parent_bits(resolution: int):
+    if not 0 <= resolution <= MAX_RESOLUTION:
+        raise AssertionError(f"H3 resolution must be between 0 and {MAX_RESOLUTION}.")
+    # digits below the resolution are unused, i.e. all ones
+    unused_digits = (1 << DIGIT_BITS * (MAX_RESOLUTION - resolution)) - 1
+    keep = ~(0xF << RESOLUTION_OFFSET) & ~unused_digits
+    return keep, (resolution << RESOLUTION_OFFSET) | unused_digits
+
+
+def parent(cell: Union[int, np.ndarray], resolution: int) -> Union[int, np.ndarray]:
+    """Returns the parent cell(s) at a coarser resolution, without calling h3.
+
+    Works for a single cell as well as numpy arrays of cells.
+    """
+    keep, add = _parent_bits(resolution)
+    if isinstance(cell, np.ndarray):
+        return (cell & np.int64(keep)) | np.int64(add)
+    return (cell & keep) | add
+
+
+def parent_sql(column: ColumnElement, resolution: int) -> ColumnElement:
+    """Returns the parent cell of an h3_cell column in SQL, e.g. to group by coarser cells."""
+    keep, add = _parent_bits(resolution)
+    return column.op("&")(keep).op("|")(add)
@@ -0,0 +1,86 @@
+import datetime
+from typing import Dict, List, Optional
+
+from slugify import slugify
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from models import Analysis, Job
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Workers hold an advisory lock (JOB_NAMESPACE, job id) while running a job.
+# If a worker dies, the lock is released and the job is queued again.
+JOB_NAMESPACE = 5151
+CHANNEL = "jobs"
+
+
+def enqueue(session: Session, city: str, arguments: List[str], environment: Optional[Dict[str, str]] = None) -> Job:
+    """Adds an import job for the city and wakes up an idle worker.
+
+    The environment variables are set for the import only, e.g. API keys
+    entered in the UI. They are deleted once the job is done.
+    """
+    job = Job(slug=slugify(city), city=city, arguments=arguments, environment=environment or {}, status=QUEUED)
+    session.add(job)
+    session.execute(text(f"NOTIFY {CHANNEL}"))
+    session.commit()
+    return job
+
+
+def cancel(session: Session, slug: str) -> bool:
+    """Cancels all queued and running jobs for the city, and returns whether a job was running.
+
+    The worker running the job notices the cancellation, terminates the
+    import and only then deletes the analysis, so this works from any server
+    process. If no job was running, delete the analysis yourself.
+    """
+    # workers skip locked jobs, so none of them is started meanwhile
+    jobs = session.query(Job).filter(
+        Job.slug == slug, Job.status.in_([QUEUED, RUNNING])
+    ).with_for_update().all()
+    running = any(job.status == RUNNING for job in jobs)
+    for job in jobs:
+        job.status = CANCELLED
+    session.execute(text(f"NOTIFY {CHANNEL}"))
+    session.commit()
+    return running
+
+
+def delete_analysis(session: Session, slug: str):
+    """Deletes the analysis of the city and all its imported data."""
+    session.query(Analysis).filter(Analysis.slug == slug).delete(synchronize_session=False)
+    session.execute(text(f'DROP SCHEMA IF EXISTS "{slug}" CASCADE'))
+    session.commit()
+
+
+def queued(session: Session) -> List[Job]:
+    """Returns the jobs that are still waiting for a worker."""
+    return session.query(Job).filter(Job.status == QUEUED).order_by(Job.id).all()
+
+
+def requeue_orphans(session: Session) -> int:
+    """Queues again the running jobs whose workers have died."""
+    result = session.execute(text(
+        f"UPDATE {Job.__tablename__} j SET status = :queued, worker = NULL WHERE status = :running"
+        " AND NOT EXISTS (SELECT 1 FROM pg_locks l WHERE l.locktype = 'advisory' AND l.granted"
+        " AND l.classid::int8 = :namespace AND l.objid::int8 = j.id AND l.objsubid = 2)"
+    ), {"queued": QUEUED, "running": RUNNING, "namespace": JOB_NAMESPACE})
+    session.commit()
+    return result.rowcount
+
+
+def finish(session: Session, job: Job, status: str, error: str = None):
+    """Marks the job done, unless it has been cancelled meanwhile."""
+    session.refresh(job)
+    if job.status != CANCELLED:
+        job.status = status
+    job.error = error
+    # don't keep the API keys around
+    job.environment = {}
+    job.finished = datetime.datetime.now()
+    session.commit()
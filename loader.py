@@ -0,0 +1,273 @@
+import itertools
+import json
+import struct
+import time
+from io import StringIO
+from logging import Logger
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from pandas import DataFrame, Series
+from pandas.api.types import is_string_dtype
+
+from geoalchemy2 import Geometry
+from shapely import wkb
+from shapely.geometry.base import BaseGeometry
+from sqlalchemy import MetaData, Table
+from sqlalchemy.engine.base import Engine
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from h3cells import cells
+from telemetry import Telemetry
+
+# Characters to read from the rows at a time, if COPY doesn't say
+CHUNK_SIZE = 1024 * 1024
+# Rows to copy at a time
+CHUNK_ROWS = 50000
+# Column for the h3 cells of the points, see models.SchemaBase
+H3_COLUMN = "h3_cell"
+# Tables and indexes are loaded by this name first, see load_table
+STAGING_SUFFIX = "_staging"
+
+
+def load_table(engine: Engine, model, rows: Iterable, logger: Logger, telemetry: Telemetry,
+               dataset: str, srid: Optional[int] = None, copy: Callable = None) -> int:
+    """Replaces the rows in the table of the model, and returns the number of rows loaded.
+
+    Rows are streamed to the table as in copy_rows, or copy_frames if given as copy.
+
+    The rows are copied to an unlogged staging table without indexes. Only then are
+    the indexes built, and the table logged and analyzed. Finally, the staging table
+    is renamed in place of the table in one transaction, so readers see the old rows
+    until the new ones are ready.
+    """
+    copy = copy or copy_rows
+    table = model.__table__
+    staging = table.to_metadata(MetaData(), name=f"{table.name}{STAGING_SUFFIX}")
+    # index names are unique in the schema, and the table still has the original ones
+    for index in staging.indexes:
+        index.name = f"{index.name}{STAGING_SUFFIX}"
+    schema = _schema(engine, table)
+    staging_name = _table_name(engine, staging)
+    try:
+        with telemetry.stage("load", dataset) as metric:
+            with engine.begin() as connection:
+                staging.drop(connection, checkfirst=True)
+                # doesn't create the indexes, only the primary key
+                connection.execute(CreateTable(staging))
+                connection.execute(f"ALTER TABLE {staging_name} SET UNLOGGED")
+            metric.rows_in, metric.rows_out = copy(engine, staging, rows, logger, srid)
+
+        with telemetry.stage("index", dataset):
+            logger.info(f"Indexing {staging_name}...")
+            with engine.begin() as connection:
+                for index in staging.indexes:
+                    connection.execute(CreateIndex(index))
+                connection.execute(f"ALTER TABLE {staging_name} SET LOGGED")
+                connection.execute(f"ANALYZE {staging_name}")
+            with engine.begin() as connection:
+                table.drop(connection, checkfirst=True)
+                connection.execute(f'ALTER TABLE {staging_name} RENAME TO "{table.name}"')
+                for index in table.indexes:
+                    connection.execute(
+                        f'ALTER INDEX {_qualified(schema, index.name + STAGING_SUFFIX)} RENAME TO "{index.name}"'
+                    )
+                if table.primary_key.columns:
+                    connection.execute(
+                        f'ALTER TABLE {_table_name(engine, table)} '
+                        f'RENAME CONSTRAINT "{staging.name}_pkey" TO "{table.name}_pkey"'
+                    )
+    except BaseException:
+        with engine.begin() as connection:
+            staging.drop(connection, checkfirst=True)
+        raise
+    return metric.rows_out
+
+
+def copy_rows(engine: Engine, model, rows: Iterable[Dict[str, Any]], logger: Logger,
+              srid: Optional[int] = None, chunk_rows: int = CHUNK_ROWS) -> Tuple[int, int]:
+    """Loads rows to the table of the model with COPY, and returns the numbers of rows copied and inserted.
+
+    Rows are dicts of column values, like the arguments of the model, without the
+    generated columns. Geometries are shapely geometries, saved with the srid given.
+    Dicts and lists are saved as json, strings to json columns are expected to be
+    json already. If the engine has a schema_translate_map, the table is loaded in
+    the translated schema.
+
+    The rows are streamed to the database in chunks, so they should be a generator
+    to keep memory use flat. Each chunk is copied to a temporary table first, and
+    inserted from there, skipping rows whose primary key is in the table already.
+    So, the rows don't have to be unique, the first one wins.
+    """
+    # the model may be a table, too
+    table = getattr(model, "__table__", model)
+    columns = _columns(table)
+    geometry_columns = {column.name for column in table.columns if isinstance(column.type, Geometry)}
+    # points get their h3 cells here, unless the importer knows them already
+    point_column = next(iter(geometry_columns), None) if H3_COLUMN in columns else None
+
+    def encode(chunk: List[Dict[str, Any]]) -> Tuple[LineReader, int]:
+        if point_column:
+            _add_cells(chunk, point_column, srid)
+        lines = (
+            "\t".join(_encode(row.get(column), column in geometry_columns, srid) for column in columns) + "\n"
+            for row in chunk
+        )
+        return LineReader(lines), len(chunk)
+
+    rows = iter(rows)
+    chunks = iter(lambda: list(itertools.islice(rows, chunk_rows)), [])
+    return _copy(engine, table, columns, (encode(chunk) for chunk in chunks), logger)
+
+
+def copy_frames(engine: Engine, model, frames: Iterable[DataFrame], logger: Logger,
+                srid: Optional[int] = None) -> Tuple[int, int]:
+    """Loads points to the table of the model with COPY, and returns the numbers of rows copied and inserted.
+
+    Does the same as copy_rows, but the rows come in data frames, and are encoded a
+    column at a time instead of a value at a time. The frames have the columns of the
+    table, except that the point geometry is given by x and y columns. Json columns are
+    expected to be json already. Each frame is copied as one chunk.
+    """
+    table = getattr(model, "__table__", model)
+    columns = _columns(table)
+    point_column = next(column.name for column in table.columns if isinstance(column.type, Geometry))
+
+    def encode(frame: DataFrame) -> Tuple[StringIO, int]:
+        frame = frame.copy()
+        xs = frame.pop("x").to_numpy(dtype=np.float64)
+        ys = frame.pop("y").to_numpy(dtype=np.float64)
+        if H3_COLUMN in columns and H3_COLUMN not in frame:
+            frame[H3_COLUMN] = cells(xs, ys, srid or 4326)
+        frame[point_column] = _encode_points(xs, ys, srid)
+        encoded = [
+            _encode_column(frame[column]) if column in frame else Series("\\N", index=frame.index)
+            for column in columns
+        ]
+        lines = encoded[0].str.cat(encoded[1:], sep="\t")
+        return StringIO("\n".join(lines) + "\n"), len(frame)
+
+    return _copy(engine, table, columns, (encode(frame) for frame in frames if len(frame)), logger)
+
+
+def _copy(engine: Engine, table: Table, columns: List[str], chunks: Iterable[Tuple[Any, int]],
+          logger: Logger) -> Tuple[int, int]:
+    # copies each chunk of COPY text to a temporary table and inserts the new rows from there
+    table_name = _table_name(engine, table)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    temp_name = f'"copy_{table.name}"'
+    copied = 0
+    inserted = 0
+    start = time.perf_counter()
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TEMPORARY TABLE {temp_name} (LIKE {table_name}) ON COMMIT DROP")
+            for text, rows in chunks:
+                cursor.copy_expert(f"COPY {temp_name} ({column_list}) FROM STDIN", text)
+                cursor.execute(
+                    f"INSERT INTO {table_name} ({column_list}) SELECT {column_list} FROM {temp_name} "
+                    f"ON CONFLICT DO NOTHING"
+                )
+                copied += rows
+                inserted += cursor.rowcount
+                cursor.execute(f"TRUNCATE {temp_name}")
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    seconds = time.perf_counter() - start
+    logger.info(f"Copied {copied} rows to {table_name} in {seconds:.1f} s, "
+                f"{copied / max(seconds, 1e-6):.0f} rows/s, skipped {copied - inserted} duplicates")
+    return copied, inserted
+
+
+def _columns(table: Table) -> List[str]:
+    # generated columns are filled in by Postgres
+    return [column.name for column in table.columns if column.computed is None]
+
+
+def _add_cells(rows: List[Dict[str, Any]], point_column: str, srid: Optional[int]):
+    # hash the whole chunk at once
+    missing = [row for row in rows if row.get(H3_COLUMN) is None and row.get(point_column) is not None]
+    if not missing:
+        return
+    xs = np.fromiter((row[point_column].x for row in missing), dtype=np.float64, count=len(missing))
+    ys = np.fromiter((row[point_column].y for row in missing), dtype=np.float64, count=len(missing))
+    for row, cell in zip(missing, cells(xs, ys, srid or 4326)):
+        row[H3_COLUMN] = int(cell)
+
+
+def _schema(engine: Engine, table: Table) -> Optional[str]:
+    schema_map = engine.get_execution_options().get("schema_translate_map") or {}
+    return schema_map.get(table.schema, table.schema)
+
+
+def _table_name(engine: Engine, table: Table) -> str:
+    return _qualified(_schema(engine, table), table.name)
+
+
+def _qualified(schema: Optional[str], name: str) -> str:
+    return f'"{schema}"."{name}"' if schema else f'"{name}"'
+
+
+def _encode(value: Any, is_geometry: bool, srid: Optional[int]) -> str:
+    # COPY text format, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.2
+    if value is None:
+        return "\\N"
+    if is_geometry and isinstance(value, BaseGeometry):
+        # EWKB hex is read as is by PostGIS
+        return wkb.dumps(value, hex=True, srid=srid) if srid else wkb.dumps(value, hex=True)
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, bool):
+        return "t" if value else "f"
+    elif not isinstance(value, str):
+        return str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _encode_column(values: Series) -> Series:
+    # the same as _encode, for a whole column
+    if values.dtype == bool:
+        return values.map({True: "t", False: "f"})
+    encoded = values.astype(str)
+    # pandas may store strings in object or string columns
+    if is_string_dtype(values) or values.dtype == object:
+        encoded = (
+            encoded.str.replace("\\", "\\\\", regex=False).str.replace("\t", "\\t", regex=False)
+            .str.replace("\n", "\\n", regex=False).str.replace("\r", "\\r", regex=False)
+        )
+    return encoded.where(values.notna(), "\\N")
+
+
+def _encode_points(xs: np.ndarray, ys: np.ndarray, srid: Optional[int]) -> np.ndarray:
+    # EWKB hex of the points: little endian byte order, point type with or without
+    # the srid flag, the srid, and the coordinates as little endian doubles
+    header = "0101000020" + struct.pack("<I", srid).hex() if srid else "0101000000"
+    coordinates = np.column_stack([xs, ys]).astype("<f8").tobytes().hex()
+    return np.char.add(header.upper(), np.frombuffer(coordinates.upper().encode(), dtype="S32").astype(str))
+
+
+class LineReader(object):
+    """File-like object reading lines from an iterator, so that COPY may stream them."""
+
+    def __init__(self, lines: Iterator[str]):
+        self.lines = lines
+        self.buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        if size < 0:
+            size = CHUNK_SIZE
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        for line in self.lines:
+            chunks.append(line)
+            length += len(line)
+            if length >= size:
+                break
+        data = "".join(chunks)
+        self.buffer = data[size:]
+        return data[:size]
@@ -0,0 +1,130 @@
+import os
+import select
+import socket
+from contextlib import contextmanager
+from logging import Logger
+from typing import Optional
+
+import psutil
+from sqlalchemy.engine.base import Engine
+
+from models import MemoryReservation
+
+GB = 1024 * 1024 * 1024
+# Advisory lock keys are (namespace, id) pairs. Id 0 guards the whole ledger,
+# other ids are held by the process owning the reservation with the same id.
+LOCK_NAMESPACE = 5150
+LEDGER_LOCK = 0
+CHANNEL = "memory_reservations"
+# Releasing a reservation wakes up the waiters at once. Crashed processes
+# can't notify anybody, so check the ledger every now and then anyway.
+POLL_INTERVAL = 10.0
+
+
+class MemoryLedger(object):
+    """Reserve memory for imports in a ledger shared by all import processes.
+
+    Each reservation keeps its own database connection, which holds an
+    advisory lock for as long as the reservation is in use. If the import
+    process crashes, its connection is closed and the lock is released, so
+    the reservation is removed from the ledger the next time anybody looks.
+    """
+
+    def __init__(self, engine: Engine, logger: Logger, capacity: Optional[float] = None):
+        self.engine = engine
+        self.logger = logger
+        self.host = socket.gethostname()
+        if not capacity:
+            capacity = float(os.getenv("IMPORT_MEMORY_GB", 0))
+        if not capacity:
+            capacity = psutil.virtual_memory().total / GB
+        self.capacity = capacity
+        MemoryReservation.__table__.create(engine, checkfirst=True)
+
+    @contextmanager
+    def reserve(self, gigabytes: float, slug: Optional[str] = None, dataset: Optional[str] = None):
+        """Waits until the memory can be reserved and releases it at exit."""
+        connection = self.engine.raw_connection()
+        # The connection holds our session level advisory lock. It must never
+        # go back to the pool, or the lock would outlive the reservation.
+        connection.detach()
+        try:
+            cursor = connection.cursor()
+            reservation_id = self._enqueue(connection, cursor, gigabytes, slug, dataset)
+            try:
+                while not self._try_grant(connection, cursor, reservation_id, gigabytes):
+                    self.logger.warning(f"Not enough memory to run {dataset} at the moment, "
+                                        f"waiting for {gigabytes} GB of {self.capacity:.1f} GB...")
+                    self._wait(connection)
+                self.logger.info(f"Reserved {gigabytes} GB of memory for {dataset}")
+                yield
+            finally:
+                self._release(connection, cursor, reservation_id)
+        finally:
+            # closing the connection releases the advisory lock in any case
+            connection.close()
+
+    def _enqueue(self, connection, cursor, gigabytes: float, slug: Optional[str], dataset: Optional[str]) -> int:
+        # Lock our reservation in the same transaction that creates it. Otherwise
+        # another process could consider it abandoned before we get the lock.
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (LOCK_NAMESPACE, LEDGER_LOCK))
+        cursor.execute(
+            f"INSERT INTO {MemoryReservation.__tablename__} (host, slug, dataset, gigabytes, pid) "
+            "VALUES (%s, %s, %s, %s, %s) RETURNING id",
+            (self.host, slug, dataset, gigabytes, os.getpid())
+        )
+        reservation_id = cursor.fetchone()[0]
+        cursor.execute("SELECT pg_advisory_lock(%s, %s)", (LOCK_NAMESPACE, reservation_id))
+        cursor.execute(f"LISTEN {CHANNEL}")
+        connection.commit()
+        return reservation_id
+
+    def _try_grant(self, connection, cursor, reservation_id: int, gigabytes: float) -> bool:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (LOCK_NAMESPACE, LEDGER_LOCK))
+        # Remove reservations whose owners have died. Their advisory locks were
+        # released together with their connections.
+        cursor.execute(
+            f"DELETE FROM {MemoryReservation.__tablename__} r WHERE NOT EXISTS ("
+            " SELECT 1 FROM pg_locks l WHERE l.locktype = 'advisory' AND l.granted"
+            " AND l.classid::int8 = %s AND l.objid::int8 = r.id AND l.objsubid = 2)",
+            (LOCK_NAMESPACE,)
+        )
+        cursor.execute(
+            f"SELECT id, gigabytes, granted FROM {MemoryReservation.__tablename__} "
+            "WHERE host = %s ORDER BY id",
+            (self.host,)
+        )
+        reservations = cursor.fetchall()
+        in_use = sum(reserved for _, reserved, granted in reservations if granted)
+        waiting = [waiting_id for waiting_id, _, granted in reservations if not granted]
+        # First come, first serve. Nobody may overtake the first waiter in line.
+        # A reservation larger than the whole capacity may still run alone.
+        granted = bool(waiting) and waiting[0] == reservation_id and (
+            in_use + gigabytes <= self.capacity or not in_use
+        )
+        if granted:
+            cursor.execute(
+                f"UPDATE {MemoryReservation.__tablename__} SET granted = true WHERE id = %s",
+                (reservation_id,)
+            )
+            # the next waiter in line may fit as well
+            cursor.execute(f"NOTIFY {CHANNEL}")
+        connection.commit()
+        return granted
+
+    @staticmethod
+    def _release(connection, cursor, reservation_id: int):
+        connection.rollback()
+        cursor.execute(f"DELETE FROM {MemoryReservation.__tablename__} WHERE id = %s", (reservation_id,))
+        cursor.execute(f"NOTIFY {CHANNEL}")
+        connection.commit()
+
+    @staticmethod
+    def _wait(connection):
+        dbapi_connection = connection.connection
+        # a release may have been notified while we were querying the ledger
+        dbapi_connection.poll()
+        if not dbapi_connection.notifies:
+            select.select([dbapi_connection], [], [], POLL_INTERVAL)
+            dbapi_connection.poll()
+        dbapi_connection.notifies.clear()
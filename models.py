@@ -1,7 +1,7 @@
 import datetime
 import json
-from sqlalchemy import Column, BigInteger, Boolean, DateTime, Index, Integer, String
-from sqlalchemy.sql import expression, func
+from sqlalchemy import Column, BigInteger, Boolean, Computed, Date, DateTime, Float, ForeignKey, Index, Integer, String
+from sqlalchemy.sql import expression, func, text
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.inspection import inspect
@@ -38,9 +38,70 @@ class Analysis(Base):
         return attrs
 
 
+# Geocoded cities, so that we don't have to ask the geocoder again. See geocode.py.
+class GeocodedCity(Base):
+    __tablename__ = 'geocoded_cities'
+    key = Column(String, primary_key=True)  # normalized city name
+    name = Column(String, nullable=False)
+    bbox = Column(Geometry(geometry_type='POLYGON', srid=4326), nullable=False)
+    centroid = Column(Geometry(geometry_type='POINT', srid=4326))
+    country = Column(String)
+    source = Column(String)  # osmnames, nominatim or osmnames dump
+    updated = Column(DateTime, nullable=False, server_default=func.now())
+
+
+# Performance metrics of each stage of an import run, see telemetry.py
+class StageMetric(Base):
+    __tablename__ = 'stage_metrics'
+    id = Column(Integer, primary_key=True)
+    analysis_id = Column(Integer, ForeignKey('analyses.id', ondelete='CASCADE'), nullable=False, index=True)
+    dataset = Column(String)  # empty for stages of the whole run, e.g. geocode and export
+    stage = Column(String, nullable=False)  # e.g. download, extract, transform, load
+    started = Column(DateTime, nullable=False)
+    wall_time = Column(Float)  # seconds
+    cpu_time = Column(Float)  # seconds, for the whole process
+    peak_rss = Column(BigInteger)  # bytes, for the whole process
+    rows_in = Column(BigInteger)
+    rows_out = Column(BigInteger)
+    bytes_downloaded = Column(BigInteger)
+
+
+# Memory reserved by running imports on each server. All import processes
+# using the same database share the ledger, see memory_ledger.py.
+class MemoryReservation(Base):
+    __tablename__ = 'memory_reservations'
+    id = Column(Integer, primary_key=True)
+    host = Column(String, nullable=False)
+    slug = Column(String)
+    dataset = Column(String)
+    gigabytes = Column(Float, nullable=False)
+    pid = Column(Integer)
+    # reservations are granted in id order, i.e. first come, first serve
+    granted = Column(Boolean, nullable=False, default=False, server_default=expression.false())
+    created = Column(DateTime, nullable=False, server_default=func.now())
+
+
+# Import jobs requested in the UI. Workers pick them up in id order, see jobs.py.
+class Job(Base):
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    slug = Column(String, nullable=False)
+    city = Column(String, nullable=False)
+    arguments = Column(JSONB)  # import.py command line arguments
+    environment = Column(JSONB)  # environment variables of the import, e.g. API keys set in the UI
+    status = Column(String, nullable=False, default='queued', server_default='queued')  # see jobs.py for statuses
+    worker = Column(String)  # worker running the job
+    error = Column(String)
+    created = Column(DateTime, nullable=False, server_default=func.now())
+    started = Column(DateTime)
+    finished = Column(DateTime)
+
+
 # This is for data in slug-specific schemas
 class SchemaBase(Base):
     __abstract__ = True
+    # extra columns to index
+    __indexed__ = ()
 
     @declared_attr
     def __table_args__(cls):
@@ -49,24 +110,58 @@ class SchemaBase(Base):
             # https://github.com/geoalchemy/geoalchemy2/issues/137
             # so we have to declare the index manually instead
             Index(f'idx_{cls.__tablename__}_geom', 'geom', postgresql_using='gist'),
+            Index(f'idx_{cls.__tablename__}_h3_cell', 'h3_cell'),
+            *cls.extra_indexes(),
             # needed for schema_translate_map
             {'schema': 'schema'}
         )
 
+    @classmethod
+    def extra_indexes(cls) -> list:
+        return [Index(f'idx_{cls.__tablename__}_{column}', column) for column in cls.__indexed__]
+
+    @declared_attr
+    def h3_cell(cls):
+        # H3 cell of the point at H3_RESOLUTION, filled in by the loader, see h3cells.py
+        return Column(BigInteger)
+
+
+def json_field(json_column: str, key: str, column_type, sql_type: str) -> Column:
+    """Returns a column Postgres generates from a key of a JSONB column.
+
+    Aggregating the column doesn't have to read and parse the whole JSON of each row.
+    The loader never writes generated columns, they are filled in from the JSON.
+    """
+    return Column(column_type, Computed(f"({json_column} ->> '{key}')::{sql_type}", persisted=True))
+
 
 class OSMPoint(SchemaBase):
     __tablename__ = 'osmpoints'
     node_id = Column(BigInteger, primary_key=True)
     tags = Column(JSONB)
+    # the key in osm_tags.tags_to_filter the point matches, or null if it is no amenity
+    category = Column(String)
     geom = Column(Geometry(geometry_type='POINT', spatial_index=False))
 
+    @classmethod
+    def extra_indexes(cls) -> list:
+        return [
+            # only the amenities are exported
+            Index('idx_osmpoints_category', 'category', postgresql_where=text('category IS NOT NULL')),
+            # for ad hoc tag queries, e.g. tags @> '{"cuisine": "pizza"}'
+            Index('idx_osmpoints_tags', 'tags', postgresql_using='gin', postgresql_ops={'tags': 'jsonb_path_ops'}),
+        ]
+
 
-# Use JSONB field for all datasets so we won't need migrations in the future
+# Use JSONB field for all datasets so we won't need migrations in the future.
+# The fields aggregated in DATASETS are generated as typed columns from the JSON.
 
 class FlickrPoint(SchemaBase):
     __tablename__ = 'flickrpoints'
+    __indexed__ = ('owner',)
     point_id = Column(BigInteger, primary_key=True)
     properties = Column(JSONB)
+    owner = json_field('properties', 'owner', String, 'text')
     geom = Column(Geometry(geometry_type='POINT', spatial_index=False))
 
 
@@ -74,6 +169,14 @@ class GTFSStop(SchemaBase):
     __tablename__ = 'gtfsstops'
     stop_id = Column(String, primary_key=True)
     properties = Column(JSONB)
+    # departures on the busiest day, and on the busiest weekday and weekend day, see gtfs_feed.FREQUENCIES
+    ntrips = json_field('properties', 'ntrips', Integer, 'integer')
+    ntrips_weekday = json_field('properties', 'ntrips_weekday', Integer, 'integer')
+    ntrips_weekday_morning = json_field('properties', 'ntrips_weekday_morning', Integer, 'integer')
+    ntrips_weekday_evening = json_field('properties', 'ntrips_weekday_evening', Integer, 'integer')
+    ntrips_weekend = json_field('properties', 'ntrips_weekend', Integer, 'integer')
+    ntrips_weekend_morning = json_field('properties', 'ntrips_weekend_morning', Integer, 'integer')
+    ntrips_weekend_evening = json_field('properties', 'ntrips_weekend_evening', Integer, 'integer')
     geom = Column(Geometry(geometry_type='POINT', spatial_index=False))
 
 
@@ -84,13 +187,18 @@ class OSMAccessNode(SchemaBase):
     __tablename__ = 'osmaccessnodes'
     node_id = Column(BigInteger, primary_key=True)
     accessibilities = Column(JSONB)
+    access_5 = json_field('accessibilities', '5', Float, 'double precision')
     geom = Column(Geometry(geometry_type='POINT', spatial_index=False))
 
 
 class OoklaPoint(SchemaBase):
     __tablename__ = 'ooklapoints'
     quadkey_id = Column(BigInteger, primary_key=True)
+    # fixed or mobile, and the first day of the quarter the tiles are of
+    type = Column(String, primary_key=True)
+    quarter = Column(Date, primary_key=True)
     properties = Column(JSONB)
+    devices = json_field('properties', 'devices', Integer, 'integer')
     geom = Column(Geometry(geometry_type='POINT', spatial_index=False))
 
 
@@ -98,4 +206,5 @@ class KonturPoint(SchemaBase):
     __tablename__ = 'konturpoints'
     hex_id = Column(BigInteger, primary_key=True)
     properties = Column(JSONB)
+    population = json_field('properties', 'population', Float, 'double precision')
     geom = Column(Geometry(geometry_type='POINT', spatial_index=False))
@@ -1,6 +1,11 @@
-from sqlalchemy import or_
+from logging import Logger
+
+from pandas import DataFrame, Series
+from sqlalchemy import case, inspect, null, update
+from sqlalchemy.engine.base import Engine
 
 from models import OSMPoint
+from util import fingerprint
 
 # This file contains the OSM tags we want to consider as amenities.
 # Edit this file to change OSM density and accessibility analysis.
@@ -65,10 +70,62 @@ tags_to_filter = {
         ]
 }
 
+# Only the points with the tags above are downloaded, and they are part of the import
+# fingerprint, so changing them imports OSM again. Imported points are classified
+# again at export if the tags have changed since, e.g. if you only export a city.
+tags_to_download = tags_to_filter
+# saved with the classified points, so we know when to classify them again
+tags_hash = fingerprint(tags_to_filter)
+
+
+def classify(tags: DataFrame) -> Series:
+    """Returns the category of each row of tag columns, i.e. the first key of tags_to_filter it matches."""
+    categories = Series([None] * len(tags), index=tags.index, dtype=object)
+    # earlier keys win
+    for tag, values in reversed(list(tags_to_filter.items())):
+        if tag in tags.columns:
+            matches = tags[tag].isin(values) if isinstance(values, list) else tags[tag].notna()
+            categories[matches] = tag
+    return categories
+
+
 # SQLAlchemy needs a bit more involved syntax to filter by value of JSONB key
 # https://docs.sqlalchemy.org/en/14/dialects/postgresql.html#sqlalchemy.dialects.postgresql.JSONB
+# The same classification as above, in SQL
+category_case = case(
+    *[(
+        OSMPoint.tags[tag].astext.in_(values) if isinstance(values, list)
+        else OSMPoint.tags.has_key(tag),
+        tag
+    ) for tag, values in tags_to_filter.items()],
+    else_=null()
+)
+
 # TODO: fix this filter to allow osmpoints *as well as* osmpolygons
-tag_filter = or_(*[(
-    OSMPoint.tags[tag].astext.in_(values) if isinstance(values, list)
-    else OSMPoint.tags.has_key(tag)
-    ) for tag, values in tags_to_filter.items()])
+tag_filter = OSMPoint.category.isnot(None)
+
+
+def save_tags_hash(engine: Engine):
+    """Marks the points in the schema of the engine classified with the current tags."""
+    engine.execute(_save_hash(engine))
+
+
+def reclassify(engine: Engine, logger: Logger):
+    """Classifies the points in the schema of the engine again, if the tags have changed since."""
+    schema = engine.get_execution_options()["schema_translate_map"]["schema"]
+    columns = inspect(engine).get_columns(OSMPoint.__tablename__, schema=schema)
+    category = next((column for column in columns if column["name"] == "category"), None)
+    if category and category.get("comment") == tags_hash:
+        return
+    logger.info(f"OSM tags have changed, classifying OSM points in {schema} again...")
+    with engine.begin() as connection:
+        if not category:
+            # imported before the points were classified
+            connection.execute(f'ALTER TABLE "{schema}"."{OSMPoint.__tablename__}" ADD COLUMN category varchar')
+        connection.execute(update(OSMPoint).values(category=category_case))
+        connection.execute(_save_hash(engine))
+
+
+def _save_hash(engine: Engine) -> str:
+    schema = engine.get_execution_options()["schema_translate_map"]["schema"]
+    return f'COMMENT ON COLUMN "{schema}"."{OSMPoint.__tablename__}"."category" IS \'{tags_hash}\''
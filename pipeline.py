@@ -0,0 +1,322 @@
+import argparse
+import copy
+import datetime
+import os
+from functools import partial
+from dotenv import load_dotenv
+from datasets import DATASETS, get_importer
+from geoalchemy2.shape import from_shape
+from ipygis import get_connection_url
+from shapely.geometry import box
+from slugify import slugify
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError, ProgrammingError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateSchema
+from sqlalchemy_utils.functions import database_exists, create_database
+from typing import Dict, List, Optional, Tuple
+
+from db import get_engine
+from geocode import Geocoder
+from h3cells import H3_RESOLUTION
+from memory_ledger import MemoryLedger
+from models import Analysis
+from scheduler import MemoryScheduler, Stage
+from telemetry import Telemetry
+from util import create_logger, fingerprint
+
+# The whole import run for a city. This is a module of its own, so that it
+# may be run by import.py as well as by the import workers of the UI.
+
+load_dotenv()
+osm_extracts_api_key = os.getenv("OSM_EXTRACTS_API_KEY")
+
+parser = argparse.ArgumentParser(description="Import all datasets for a given city")
+parser.add_argument("city", nargs="?", help="City to import")
+parser.add_argument("--gtfs", help="Optional GTFS feed URL(s). E.g. \"http://web.mta.info/developers/data/nyct/subway/google_transit.zip http://web.mta.info/developers/data/nyct/bus/google_transit_manhattan.zip\""
+)
+parser.add_argument("--ookla-quarters",
+                    help="Ookla quarters to import. Default is 2021-1. E.g. \"2020-1:2021-4\" or \"2020-4 2021-4\"")
+parser.add_argument("--ookla-types",
+                    help="Ookla tile types to import. Default is fixed. E.g. \"fixed mobile\"")
+parser.add_argument("--datasets",
+                    default=" ".join([dataset for dataset in DATASETS]),
+                    help="Datasets to import. Default is to import all. E.g. \"osm gtfs access ookla kontur\""
+                    )
+parser.add_argument("--bbox", help="Use different bbox for the city. Format \"minx miny maxx maxy\"")
+parser.add_argument("--export",
+                    action="store_true",
+                    default=False,
+                    help="Automatically run analysis and create result map at the end of import.",
+                    )
+parser.add_argument("--delete",
+                    action="store_true",
+                    default=False,
+                    help="Delete imported data from the database when the visualization is finished. Default is False."
+                         " The result map is independent from the analysis database, so you may save a lot of disk space"
+                         " by deleting the data if you don't expect to create the map again.")
+parser.add_argument("--parallel",
+                    type=int,
+                    default=1,
+                    help="Number of datasets to import concurrently. Default is 1, i.e. import datasets one by one.")
+parser.add_argument("--memory",
+                    type=float,
+                    default=None,
+                    help="Memory in GB all imports on this server may use at the same time. Default is"
+                         " IMPORT_MEMORY_GB, or all the memory of the server.")
+parser.add_argument("--batch",
+                    help="Import all the cities listed in a file instead, one city per line. You may give the bbox"
+                         " after the city name and a tab, e.g. \"Helsinki\t24.82 60.14 25.06 60.29\". Global sources"
+                         " such as Kontur and Ookla are only read once for all the cities.")
+parser.add_argument("--force",
+                    action="store_true",
+                    default=False,
+                    help="Import all datasets again. By default, datasets that have already been imported"
+                         " with the same bounding box and parameters are skipped.")
+
+
+def read_parameters(args: Dict) -> Dict:
+    """Returns the parameters of the datasets, with arguments parsed by the parser above."""
+    gtfs_url_string = args.get("gtfs", None) or ""
+    # mark params like {gtfs: {urls: [http://example.com, http://another-url.com]}}
+    parameters = {'gtfs': {'urls': gtfs_url_string.split()}}
+    if args.get("ookla_quarters") or args.get("ookla_types"):
+        parameters['ookla'] = {
+            'quarters': (args.get("ookla_quarters") or "").split(),
+            'types': (args.get("ookla_types") or "").split()
+        }
+    return parameters
+
+
+def columns(dataset: str) -> List[str]:
+    """Returns the columns of the dataset table. Tables saved with other columns must be imported again."""
+    return [column.name for column in DATASETS[dataset]["model"].__table__.columns]
+
+
+def memory(dataset: str, importer, parameters: Dict) -> float:
+    """Returns the memory in GB the importer needs, more if the global sources must be prepared first."""
+    if hasattr(importer, "prepared") and not importer.prepared(parameters):
+        return DATASETS[dataset]["prepare_memory"]
+    return DATASETS[dataset]["memory"]
+
+
+def run_import(args: Dict):
+    """Imports the datasets for the city, with arguments parsed by the parser above."""
+    city = args["city"]
+    slug = slugify(city)
+    datasets = args["datasets"].split()
+    parameters = read_parameters(args)
+    bbox = args.get("bbox", None)
+    export = args.get("export", False)
+    delete = args.get("delete", False)
+    parallel = args.get("parallel", 1)
+    memory_budget = args.get("memory", None)
+    force = args.get("force", False)
+
+    # log each city separately
+    logger = create_logger(slug)
+    logger.info(f"--- Importing datasets {datasets} for {city} ---")
+    # stage metrics are saved once we have the analysis in the db
+    telemetry = Telemetry(logger)
+
+    # save all analysis requests to the db
+    sql_url = get_connection_url(dbname="geoviz")
+    # create db if this is the first run
+    if not database_exists(sql_url):
+        create_database(sql_url)
+    # all the importers and the export share the connection pool
+    engine = get_engine()
+
+    # only do geocoding if the user has not provided bounding box
+    if bbox:
+        bbox = bbox.split()
+    else:
+        with telemetry.stage("geocode"):
+            bbox = Geocoder(engine, logger).geocode(city)
+    # bbox must always be float
+    bbox = [float(coord) for coord in bbox]
+
+    session = sessionmaker(bind=engine)()
+    Analysis.__table__.create(engine, checkfirst=True)
+    analysis = Analysis(
+        slug=slug,
+        name=city,
+        bbox=from_shape(box(*bbox)),
+        # mark datasets like {selected: ['osm', 'gtfs'], imported: ['osm']}
+        datasets={"selected": datasets, "imported": []},
+        parameters=parameters
+    )
+    session.add(analysis)
+
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        # there is an analysis for the city already. merge the datasets
+        logger.info(f"Analysis for {city} found already. Overwriting selected datasets.")
+        analysis = session.query(Analysis).filter(Analysis.slug == slug).first()
+        analysis.bbox = from_shape(box(*bbox))
+        analysis.viewed = False
+        analysis.finish_time = None
+        if parameters["gtfs"]["urls"] or "ookla" in parameters:
+            analysis.parameters = parameters
+        analysis.datasets = copy.deepcopy(analysis.datasets)
+        analysis.datasets["selected"] = datasets
+        session.commit()
+    telemetry.bind(engine, analysis.id)
+
+    # create schema for the analysis
+    try:
+        engine.execute(CreateSchema(slug))
+    except ProgrammingError:
+        # the schema may exist if some datasets have already been imported
+        pass
+
+    # Save analysis progress to the db as well. Each imported dataset is marked with
+    # the fingerprint of its parameters, so we know if it has to be imported again.
+    fingerprints = {}
+
+    def mark_imported(dataset: str):
+        # we must create a whole new datasets dict to update the binary object in db
+        analysis.datasets = copy.deepcopy(analysis.datasets)
+        if dataset not in analysis.datasets["imported"]:
+            analysis.datasets["imported"].append(dataset)
+        analysis.datasets.setdefault("fingerprints", {})[dataset] = fingerprints[dataset]
+        session.commit()
+
+    def unmark_imported(datasets_to_import: List[str]):
+        # if we crash, we know these are not finished
+        analysis.datasets = copy.deepcopy(analysis.datasets)
+        for dataset in datasets_to_import:
+            if dataset in analysis.datasets["imported"]:
+                analysis.datasets["imported"].remove(dataset)
+            analysis.datasets.setdefault("fingerprints", {}).pop(dataset, None)
+        session.commit()
+
+    def is_imported(stage: Stage) -> bool:
+        if force or stage.dataset not in analysis.datasets["imported"]:
+            return False
+        if analysis.datasets.get("fingerprints", {}).get(stage.dataset) != fingerprints[stage.dataset]:
+            return False
+        # the data may have been deleted after export
+        table_name = DATASETS[stage.dataset]["model"].__tablename__
+        return inspect(engine).has_table(table_name, schema=slug)
+
+    # Some imports are memory hogs. We don't want to run too many concurrently.
+    # First come, first serve. This only matters when multiple cities are imported
+    # at the same time. So, the server size limits the number of concurrent imports.
+    ledger = MemoryLedger(engine, logger, memory_budget)
+
+    def run_stage(stage: Stage):
+        with ledger.reserve(stage.memory, slug, stage.dataset):
+            stage.run()
+
+    logger.info(f"{city} bounding box {bbox}")
+
+    # Each stage declares the memory it needs at its peak, in GB, and the source
+    # parameters that, together with the bbox, define the imported data.
+    # Only the importers of the selected datasets are loaded.
+    stages = []
+    for dataset in DATASETS:
+        if dataset not in datasets:
+            continue
+        importer = get_importer(dataset)
+        dataset_parameters = parameters.get(dataset, {})
+        run = partial(importer.import_city, slug, city, bbox, logger, telemetry, engine, dataset_parameters)
+        stages.append(Stage(dataset, memory(dataset, importer, dataset_parameters), run,
+                            importer.source(city, dataset_parameters, logger)))
+
+    stages_to_import = []
+    for stage in stages:
+        fingerprints[stage.dataset] = fingerprint(bbox, stage.source, H3_RESOLUTION, columns(stage.dataset))
+        if is_imported(stage):
+            logger.info(f"{stage.dataset} already imported with the same parameters, skipping.")
+        else:
+            stages_to_import.append(stage)
+    stages = stages_to_import
+    unmark_imported([stage.dataset for stage in stages])
+
+    if parallel > 1:
+        logger.info(f"Importing up to {parallel} datasets at a time within {ledger.capacity:.1f} GB")
+        # mark_imported is called in this thread, so the session is never shared
+        reserved_stages = [
+            Stage(stage.dataset, stage.memory, partial(run_stage, stage), stage.source) for stage in stages
+        ]
+        # the stages reserve their memory in the ledger shared with other imports, so it's
+        # not counted here again
+        MemoryScheduler(parallel, None, logger).run(reserved_stages, mark_imported)
+    else:
+        for stage in stages:
+            run_stage(stage)
+            mark_imported(stage.dataset)
+
+    logger.info(f"--- Datasets {datasets} for {city} imported to PostGIS ---")
+
+    if export:
+        logger.info(f"--- Creating result map for {city} ---")
+        # the map libraries are only loaded when needed
+        from export import run_export
+        with ledger.reserve(3, slug, "export"), telemetry.stage("export"):
+            run_export(slug, datasets, delete, engine=engine, logger=logger)
+
+    analysis.finish_time = datetime.datetime.now()
+    session.commit()
+
+
+def read_batch(path: str) -> List[Tuple[str, Optional[str]]]:
+    """Returns the cities in the batch file, with their bboxes if given."""
+    cities = []
+    with open(path, encoding="utf-8") as batch_file:
+        for line in batch_file:
+            if not line.strip() or line.startswith("#"):
+                continue
+            city, _, bbox = line.rstrip("\n").partition("\t")
+            cities.append((city.strip(), bbox.strip() or None))
+    return cities
+
+
+def run_batch(args: Dict):
+    """Imports the datasets for all the cities in the batch file.
+
+    Global sources are downloaded and prepared once before importing the cities
+    one by one. A city that fails to import doesn't stop the rest.
+    """
+    datasets = args["datasets"].split()
+    logger = create_logger("batch")
+    telemetry = Telemetry(logger)
+    cities = read_batch(args["batch"])
+    logger.info(f"--- Importing datasets {datasets} for {len(cities)} cities ---")
+
+    sql_url = get_connection_url(dbname="geoviz")
+    if not database_exists(sql_url):
+        create_database(sql_url)
+    parameters = read_parameters(args)
+
+    ledger = MemoryLedger(get_engine(), logger, args.get("memory"))
+    for dataset in DATASETS:
+        if dataset not in datasets:
+            continue
+        importer = get_importer(dataset)
+        if hasattr(importer, "prepare"):
+            dataset_parameters = parameters.get(dataset, {})
+            with ledger.reserve(memory(dataset, importer, dataset_parameters), dataset=dataset):
+                importer.prepare(logger, telemetry, dataset_parameters)
+
+    failed = []
+    slugs = set()
+    for city, bbox in cities:
+        if slugify(city) in slugs:
+            logger.warning(f"{city} is in the batch more than once, importing it once")
+            continue
+        slugs.add(slugify(city))
+        # the cities find the global sources ready. Cities without a bbox are geocoded
+        # by run_import, so a city that isn't found fails alone.
+        city_args = dict(args, city=city, bbox=bbox, batch=None)
+        try:
+            run_import(city_args)
+        except Exception:
+            logger.exception(f"Importing {city} failed")
+            failed.append(city)
+    if failed:
+        raise RuntimeError(f"Importing {', '.join(failed)} failed")
+    logger.info(f"--- Datasets {datasets} for {len(cities)} cities imported ---")
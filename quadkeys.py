@@ -0,0 +1,63 @@
+import math
+from typing import List, Tuple
+
+import numpy as np
+
+# Ookla tiles are web mercator tiles at zoom 16. Their quadkeys are saved as
+# integers, so each decimal digit is one zoom level of the quadkey.
+TILE_ZOOM = 16
+
+
+def parent(quadkeys: np.ndarray, zoom: int, tile_zoom: int = TILE_ZOOM) -> np.ndarray:
+    """Returns the quadkeys of the tiles at a lower zoom containing the tiles."""
+    return np.asarray(quadkeys, dtype=np.int64) // 10 ** (tile_zoom - zoom)
+
+
+def centers(quadkeys: np.ndarray, zoom: int = TILE_ZOOM) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the x and y coordinates of the centers of the tiles in EPSG:4326.
+
+    The center is the middle of the tile in degrees, i.e. the centroid of the
+    tile polygon, not the center of the tile in web mercator.
+    """
+    quadkeys = np.asarray(quadkeys, dtype=np.int64)
+    # one column per zoom level, 0-3
+    digits = quadkeys[:, np.newaxis] // 10 ** np.arange(zoom - 1, -1, -1, dtype=np.int64) % 10
+    weights = 1 << np.arange(zoom - 1, -1, -1, dtype=np.int64)
+    tile_xs = ((digits & 1) * weights).sum(axis=1)
+    tile_ys = ((digits >> 1) * weights).sum(axis=1)
+    tiles = 2 ** zoom
+    xs = (tile_xs + 0.5) / tiles * 360 - 180
+    ys = (_latitude(tile_ys, tiles) + _latitude(tile_ys + 1, tiles)) / 2
+    return xs, ys
+
+
+def covering(bbox: List[float], zoom: int) -> List[int]:
+    """Returns the quadkeys of the tiles at the zoom covering the bbox (minx, miny, maxx, maxy) in EPSG:4326."""
+    minx, miny, maxx, maxy = bbox
+    tiles = 2 ** zoom
+    tile_xs = range(_tile_x(minx, tiles), _tile_x(maxx, tiles) + 1)
+    # tile y grows to the south
+    tile_ys = range(_tile_y(maxy, tiles), _tile_y(miny, tiles) + 1)
+    return [_quadkey(tile_x, tile_y, zoom) for tile_x in tile_xs for tile_y in tile_ys]
+
+
+def _latitude(tile_ys: np.ndarray, tiles: int) -> np.ndarray:
+    # latitude of the north edge of the tiles
+    return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * tile_ys / tiles))))
+
+
+def _tile_x(x: float, tiles: int) -> int:
+    return min(max(int((x + 180) / 360 * tiles), 0), tiles - 1)
+
+
+def _tile_y(y: float, tiles: int) -> int:
+    latitude = math.radians(y)
+    tile_y = int((1 - math.asinh(math.tan(latitude)) / math.pi) / 2 * tiles)
+    return min(max(tile_y, 0), tiles - 1)
+
+
+def _quadkey(tile_x: int, tile_y: int, zoom: int) -> int:
+    quadkey = 0
+    for bit in range(zoom - 1, -1, -1):
+        quadkey = quadkey * 10 + ((tile_x >> bit) & 1) + (((tile_y >> bit) & 1) << 1)
+    return quadkey
@@ -0,0 +1,84 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from logging import Logger
+from typing import Callable, Dict, List, Optional
+
+
+class Stage(object):
+    """A single import stage and the memory (in GB) it needs at its peak.
+
+    The source contains the parameters, other than the bbox, that identify
+    the imported data, e.g. the URL and version of the source data.
+    """
+
+    def __init__(self, dataset: str, memory: float, run: Callable[[], None], source: Optional[Dict] = None):
+        self.dataset = dataset
+        self.memory = memory
+        self.run = run
+        self.source = source or {}
+
+    def __repr__(self):
+        return f"Stage({self.dataset}, {self.memory} GB)"
+
+
+class MemoryScheduler(object):
+    """Run import stages concurrently without exceeding a memory budget.
+
+    Stages are admitted in the order given, as long as there are free
+    workers and the memory they declare fits the remaining budget. A stage
+    that cannot fit yet does not block smaller stages behind it. A stage
+    that is larger than the whole budget is only run alone. Without a budget,
+    only the number of concurrent stages is limited, e.g. if the stages
+    reserve their memory in the MemoryLedger themselves.
+    """
+
+    def __init__(self, parallel: int, memory_budget: Optional[float], logger: Logger):
+        if parallel < 1:
+            raise AssertionError("You must allow at least one concurrent stage.")
+        self.parallel = parallel
+        self.memory_budget = memory_budget
+        self.logger = logger
+
+    def _fits(self, stage: Stage, reserved: float, running: int) -> bool:
+        if running >= self.parallel:
+            return False
+        if not running or self.memory_budget is None:
+            return True
+        return reserved + stage.memory <= self.memory_budget
+
+    def run(self, stages: List[Stage], on_finished: Callable[[str], None]):
+        """Runs all stages, calling on_finished(dataset) in this thread as each one finishes.
+
+        If a stage fails, no new stages are started. The stages already
+        running are allowed to finish before the first error is raised.
+        """
+        pending = list(stages)
+        running = {}
+        reserved = 0
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            while pending or running:
+                for stage in list(pending):
+                    if not self._fits(stage, reserved, len(running)):
+                        continue
+                    pending.remove(stage)
+                    reserved += stage.memory
+                    if self.memory_budget is None:
+                        self.logger.info(f"Starting {stage.dataset} import")
+                    else:
+                        self.logger.info(f"Starting {stage.dataset} import, "
+                                         f"{reserved}/{self.memory_budget} GB reserved")
+                    running[executor.submit(stage.run)] = stage
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    reserved -= stage.memory
+                    error = future.exception()
+                    if error:
+                        self.logger.error(f"Importing {stage.dataset} failed: {error!r}")
+                        errors.append(error)
+                        # let the running stages finish, but don't start new ones
+                        pending.clear()
+                    else:
+                        on_finished(stage.dataset)
+        if errors:
+            raise errors[0]
@@ -6,21 +6,22 @@ import os
 import sys
 from flickrapi import FlickrAPI, FlickrError
 from dotenv import load_dotenv
-from ipygis import get_connection_url
 from shapely.geometry import Point
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from typing import List
-from geoalchemy2.shape import from_shape
+from sqlalchemy.engine.base import Engine
+from typing import Dict, List, Optional
 from slugify import slugify
 
 # test simple import now, convert to module later
 sys.path.insert(0, "..")
+from db import get_engine, with_schema
+from loader import load_table
 from models import FlickrPoint
+from telemetry import Telemetry
 
 
 class FlickrImporter:
-    def __init__(self, slug: str, bbox: List[float], logger: Logger):
+    def __init__(self, slug: str, bbox: List[float], logger: Logger, telemetry: Optional[Telemetry] = None,
+                 engine: Optional[Engine] = None):
         """Sets the initial parameters, connects to flickr and database"""
         if not slug:
             raise AssertionError("You must specify the city name.")
@@ -33,6 +34,7 @@ class FlickrImporter:
         # List for api request parameter tuples
         self.start_params = [(total_bbox, start_date, end_date)]
         self.logger = logger
+        self.telemetry = telemetry or Telemetry(logger)
 
         # List for photos
         self.photos = []
@@ -48,37 +50,47 @@ class FlickrImporter:
         )
 
         # Database
-        sql_url = get_connection_url(dbname="geoviz")
-        engine = create_engine(sql_url)
-        schema_engine = engine.execution_options(
-            schema_translate_map={'schema': slug}
-        )
-        self.session = sessionmaker(bind=schema_engine)()
-        FlickrPoint.__table__.drop(schema_engine, checkfirst=True)
-        FlickrPoint.__table__.create(schema_engine)
+        # share the connection pool of the import run
+        schema_engine = with_schema(engine or get_engine(), slug)
+        self.engine = schema_engine
+        # the table is replaced once the new data is loaded
+        FlickrPoint.__table__.create(schema_engine, checkfirst=True)
+
+    @classmethod
+    def source(cls, city: str, parameters: Dict, logger: Logger) -> Dict:
+        # Flickr photos are always searched for the last three years
+        return {"date": datetime.date.today().isoformat()}
+
+    @classmethod
+    def import_city(cls, slug: str, city: str, bbox: List[float], logger: Logger, telemetry: Telemetry, engine: Engine,
+                    parameters: Dict):
+        logger.info(f"--- Importing Flickr data for {city} ---")
+        cls(slug, bbox, logger, telemetry, engine).run()
 
     def run(self):
         """Downloads photo locations and saves them to database"""
 
         # Download photos
-        self.loop(self.start_params)
+        with self.telemetry.stage("download", "flickr") as metric:
+            self.loop(self.start_params)
+            metric.rows_out = len(self.photos)
 
         # Save the photo locations
-        flickr_points = {}
-        self.logger.info(f"Found {len(self.photos)} Flickr photos, importing...")
-        for point in self.photos:
-            pid = point.pop("id")
-            geom = from_shape(
-                Point(float(point.pop("longitude")),
-                      float(point.pop("latitude"))), srid=4326
-            )
-            # Use dict, since the json may contain the same image twice!
-            if pid in flickr_points:
-                self.logger.info(f"Image {pid} found twice, overwriting")
-            flickr_points[pid] = FlickrPoint(point_id=pid, properties=point, geom=geom)
+        with self.telemetry.stage("transform", "flickr") as metric:
+            flickr_points = {}
+            self.logger.info(f"Found {len(self.photos)} Flickr photos, importing...")
+            metric.rows_in = len(self.photos)
+            for point in self.photos:
+                pid = point.pop("id")
+                geom = Point(float(point.pop("longitude")), float(point.pop("latitude")))
+                # Use dict, since the json may contain the same image twice!
+                if pid in flickr_points:
+                    self.logger.info(f"Image {pid} found twice, overwriting")
+                flickr_points[pid] = {"point_id": pid, "properties": point, "geom": geom}
+            metric.rows_out = len(flickr_points)
+
         self.logger.info(f"Saving {len(flickr_points)} flickr points...")
-        self.session.bulk_save_objects(flickr_points.values())
-        self.session.commit()
+        load_table(self.engine, FlickrPoint, flickr_points.values(), self.logger, self.telemetry, "flickr", srid=4326)
 
     def loop(self, params_list: list):
         """The main download loop
@@ -1,21 +1,25 @@
 import argparse
+import datetime
+import itertools
 import logging
 from logging import Logger
 import os
 import sys
-import requests
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional
+from urllib.parse import urlparse
 
 from slugify import slugify
-from gtfs_functions import import_gtfs, stops_freq
-from ipygis import get_connection_url
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from geoalchemy2.shape import from_shape
+from sqlalchemy.engine.base import Engine
 
 # test simple import now, convert to module later
 sys.path.insert(0, "..")
+from db import get_engine, with_schema
+from download import refresh, version
+from gtfs_feed import frequencies, read_feed
+from loader import load_table
 from models import GTFSStop
+from telemetry import Telemetry
+from util import fingerprint
 
 GTFS_DATASETS = {
     "Helsinki": "https://infopalvelut.storage.hsldev.com/gtfs/hsl.zip",
@@ -43,7 +47,9 @@ DATA_PATH = "data"
 
 
 class GTFSImporter(object):
-    def __init__(self, slug: str, city: str, logger: Logger, url: str = "", bbox: List[float] = None, dataset_number: Optional[int] = None):
+    def __init__(self, slug: str, city: str, logger: Logger, url: str = "", bbox: List[float] = None, dataset_number: Optional[int] = None,
+                 telemetry: Optional[Telemetry] = None,
+                 engine: Optional[Engine] = None):
         if not city or not slug:
             raise AssertionError("You must specify the city name.")
         self.city = city
@@ -54,84 +60,100 @@ class GTFSImporter(object):
         # - In some cities, multiple stops by different companies in different places may share the same id.
         self.dataset_number = dataset_number
         self.logger = logger
+        self.telemetry = telemetry or Telemetry(logger)
         if url:
             self.url = url
         else:
             self.url = GTFS_DATASETS.get(city, None)
 
-        sql_url = get_connection_url(dbname="geoviz")
-        engine = create_engine(sql_url)
-        schema_engine = engine.execution_options(
-            schema_translate_map={'schema': slug}
-        )
-        self.session = sessionmaker(bind=schema_engine)()
+        # share the connection pool of the import run
+        schema_engine = with_schema(engine or get_engine(), slug)
+        self.engine = schema_engine
 
-        # We may import multiple gtfs datasets to the same table.
-        if not self.dataset_number:
-            GTFSStop.__table__.drop(schema_engine, checkfirst=True)
+        # the table is replaced once the new data is loaded
         GTFSStop.__table__.create(schema_engine, checkfirst=True)
 
+    @classmethod
+    def source(cls, city: str, parameters: Dict, logger: Logger) -> Dict:
+        urls = parameters.get("urls") or [GTFS_DATASETS.get(city, None)]
+        # the feed at the url may change, so the version of the feed identifies the data, too
+        return {"urls": urls, "versions": [cls.feed_version(url, logger) for url in urls]}
+
+    @classmethod
+    def import_city(cls, slug: str, city: str, bbox: List[float], logger: Logger, telemetry: Telemetry, engine: Engine,
+                    parameters: Dict):
+        # GTFS importer uses the provided URL(s) or, failing that, default values for some cities
+        urls = parameters.get("urls") or []
+        if not urls:
+            logger.info(f"--- Importing GTFS data for {city} ---")
+            cls(slug, city, logger, bbox=bbox, telemetry=telemetry, engine=engine).run()
+            return
+        # We may import multiple gtfs datasets to the same table.
+        feeds = []
+        importer = None
+        for index, url in enumerate(urls, start=1):
+            logger.info(f"--- Importing GTFS dataset #{index} from {url} ---")
+            # Enumerate the gtfs stops according to which dataset they came from
+            importer = cls(slug, city, logger, url, bbox, index, telemetry, engine)
+            feeds.append(importer.stops())
+        importer.save(itertools.chain(*feeds))
+
+    @classmethod
+    def feed_path(cls, url: str) -> str:
+        """Returns the path of the saved feed. Cities using the same feed share the file."""
+        # data should be stored one directory level above importers
+        feeds_path = os.path.join(os.path.dirname(os.path.dirname(__loader__.path)), DATA_PATH, "gtfs")
+        os.makedirs(feeds_path, exist_ok=True)
+        name = os.path.basename(urlparse(url).path) or "gtfs.zip"
+        return os.path.join(feeds_path, f"{fingerprint(url)[:16]}-{name}")
+
+    @classmethod
+    def feed_version(cls, url: Optional[str], logger: Logger) -> Optional[str]:
+        """Returns the ETag or Last-Modified of the feed at the url. The feed is downloaded when importing."""
+        if not url:
+            return None
+        # without them, we can't tell if the feed has changed, so it is imported again every time
+        return version(url, cls.feed_path(url), logger) or datetime.datetime.now().isoformat()
+
     def run(self):
+        self.save(self.stops())
+
+    def save(self, stops: Iterator[Dict]):
+        self.logger.info("Saving GTFS stops...")
+        load_table(self.engine, GTFSStop, stops, self.logger, self.telemetry, "gtfs", srid=4326)
+
+    def stops(self) -> Iterator[Dict]:
+        """Downloads the feed and returns its stops with their frequencies."""
         if not self.url:
             self.logger.error(f"GTFS data not found for {self.city}, skipping.")
-            return
-        # data should be stored one directory level above importers
-        # Reload the data from the URL, *don't* rely on saved zip if url is provided!!
-        # Note that we may have multiple gtfs feeds per city.
-        file_path = os.path.join(
-            os.path.dirname(os.path.dirname(__loader__.path)),
-            DATA_PATH
-        )
-        if self.dataset_number:
-            filename = os.path.join(file_path, f"{self.city}-{self.dataset_number}.gtfs.zip")
-        else:
-            filename = os.path.join(file_path, f"{self.city}.gtfs.zip")
-        self.logger.info("Downloading gtfs zip...")
-        response = requests.get(self.url, allow_redirects=True)
-        # always reload the GTFS feed, we don't want to save old feeds if new ones are present
-        with open(filename, 'wb') as file:
-            file.write(response.content)
-
-        self.logger.info("Loading gtfs zip...")
-        routes, stops, stop_times, trips, shapes = import_gtfs(filename)
-        # TODO: delete file after reading, we don't want to keep caching them all?
-        # This is the only large dataset we download separately. or is gtfs data valuable?
-
-        # only analyze stops within bbox, to cut down processing time
-        # luckily, we have nifty bbox filtering available for geodataframes
-        # https://geopandas.org/docs/user_guide/indexing.html
-        if self.bbox:
-            self.logger.info("Filtering gtfs data with bbox...")
-            self.logger.info(self.bbox)
-            stops = stops.cx[self.bbox[0]:self.bbox[2], self.bbox[1]:self.bbox[3]]
-            stop_times = stop_times.cx[self.bbox[0]:self.bbox[2], self.bbox[1]:self.bbox[3]]
-
-        # only calculate average daily frequency for all stops for now
-        cutoffs = [0, 24]
-        self.logger.info("Calculating stop frequencies...")
-        stop_frequencies = stops_freq(stop_times, stops, cutoffs)
-        # only consider outbound departures for now
-        outbound_frequencies = stop_frequencies.loc[
-            stop_frequencies["dir_id"] == "Outbound"
-        ].to_dict(orient="records")
-        # Some feeds don't have two directions. In that case, all
-        # stops are inbound
-        if not outbound_frequencies:
-            outbound_frequencies = stop_frequencies.to_dict(orient="records")
-        stops_to_save = {}
-        self.logger.info(f"Found {len(outbound_frequencies)} GTFS stops, importing...")
-        for stop in outbound_frequencies:
+            return iter([])
+        with self.telemetry.stage("download", "gtfs") as metric:
+            filename = self.feed_path(self.url)
+            # always check for a newer feed, we don't want to use old feeds if new ones are present
+            metric.bytes_downloaded = refresh(self.url, filename, self.logger)
+
+        with self.telemetry.stage("transform", "gtfs") as metric:
+            # only the stops within the bbox and their stop times are read, so memory use
+            # depends on the size of the city, not the size of the feed
+            self.logger.info("Reading gtfs zip...")
+            stops, stop_times, dates = read_feed(filename, self.bbox, self.logger)
+            metric.rows_in = len(stop_times)
+
+            # departures of all directions are counted on the busiest days of the feed
+            self.logger.info("Calculating stop frequencies...")
+            stop_frequencies = frequencies(stops, stop_times, dates, self.logger).to_dict(orient="records")
+            self.logger.info(f"Found {len(stop_frequencies)} GTFS stops, importing...")
+            metric.rows_out = len(stop_frequencies)
+        return self._rows(stop_frequencies)
+
+    def _rows(self, stops: List[Dict]) -> Iterator[Dict]:
+        # the feeds may contain the same stop twice, the loader only saves the first one
+        for stop in stops:
             stop_id = stop.pop("stop_id")
             if self.dataset_number:
                 stop_id = f"{self.dataset_number}-{stop_id}"
-            geom = from_shape(stop.pop("geometry"), srid=4326)
-            # use dict, since the json may contain the same stop twice!
-            if stop_id in stops_to_save:
-                self.logger.info(f"Stop {stop_id} found twice, overwriting")
-            stops_to_save[stop_id] = GTFSStop(stop_id=stop_id, properties=stop, geom=geom)
-        self.logger.info(f"Saving {len(stops_to_save)} GTFS stops...")
-        self.session.bulk_save_objects(stops_to_save.values())
-        self.session.commit()
+            geom = stop.pop("geometry")
+            yield {"stop_id": stop_id, "properties": stop, "geom": geom}
 
 
 if __name__ == "__main__":
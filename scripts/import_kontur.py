@@ -2,114 +2,213 @@ import argparse
 import logging
 from logging import Logger
 
-import fiona
 import gzip
 import os
+import sqlite3
 import sys
-import requests
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import shutil
-from ipygis import get_connection_url
-from osgeo import gdal
-from shapely.geometry import Polygon
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from typing import List
-from geoalchemy2.shape import from_shape
+from pandas import DataFrame
+from pyproj import Transformer
+from sqlalchemy.engine.base import Engine
+from typing import Dict, Iterator, List, Optional
 from slugify import slugify
 
 # test simple import now, convert to module later
 sys.path.insert(0, "..")
+from db import get_engine, with_schema
+from download import download, locked
+from h3cells import H3_RESOLUTION, centroids, covering, parent
+from loader import copy_frames, load_table
 from models import KonturPoint
+from telemetry import Telemetry
 
 DATA_PATH = "data"
+# H3 resolution of the partitions. A city only has to read the partitions around it.
+PARTITION_RESOLUTION = 3
+# H3 resolution of the Kontur hexes
+KONTUR_RESOLUTION = 8
+# Rows to read from the geopackage at a time
+CHUNK_ROWS = 1000000
 
 
 class KonturImporter(object):
+    # the data source also identifies the imported data version
+    download_url = "https://adhoc.kontur.io/data/"
+    download_name = "kontur_population_20200928.gpkg"
+    # data should be stored one directory level above importers
+    unzipped_file = os.path.join(
+        os.path.dirname(os.path.dirname(__loader__.path)),
+        DATA_PATH,
+        download_name
+    )
+    download_file = unzipped_file + ".gz"
+    # the global data is saved in a parquet file per H3 cell at PARTITION_RESOLUTION
+    partitions_path = f"{unzipped_file}_partitions"
 
-    def __init__(self, slug: str, city: str, bbox: List[float], logger: Logger):
+    def __init__(self, slug: str, city: str, bbox: List[float], logger: Logger, telemetry: Optional[Telemetry] = None,
+                 engine: Optional[Engine] = None):
         if not city or not slug:
             raise AssertionError("You must specify the city name.")
         # BBOX (minx, miny, maxx, maxy)
         self.bbox = bbox
         self.city = city
-        self.download_url = "https://adhoc.kontur.io/data/"
-        self.download_name = "kontur_population_20200928.gpkg"
         self.logger = logger
+        self.telemetry = telemetry or Telemetry(logger)
 
-        # data should be stored one directory level above importers
-        self.unzipped_file = os.path.join(
-            os.path.dirname(os.path.dirname(__loader__.path)),
-            DATA_PATH,
-            self.download_name
-        )
-        self.download_file = self.unzipped_file + ".gz"
-        self.city_file = f"{self.unzipped_file}_extracts/{self.city}.gpkg"
-
-        sql_url = get_connection_url(dbname="geoviz")
-        engine = create_engine(sql_url)
-        # TODO: prevent injection by schema slug. just
-        # check if schema exists (e.g. public) and crash
-        schema_engine = engine.execution_options(
-            schema_translate_map={'schema': slug}
-        )
-        self.session = sessionmaker(bind=schema_engine)()
-        KonturPoint.__table__.drop(schema_engine, checkfirst=True)
-        KonturPoint.__table__.create(schema_engine)
+        # share the connection pool of the import run
+        schema_engine = with_schema(engine or get_engine(), slug)
+        self.engine = schema_engine
+        # the table is replaced once the new data is loaded
+        KonturPoint.__table__.create(schema_engine, checkfirst=True)
 
-    def run(self):
-        if os.path.isfile(self.download_file):
-            self.logger.info("Found saved Kontur data...")
-        else:
-            self.logger.info("Downloading Kontur data...")
-            self.logger.info(f"{self.download_url}{self.download_name}.gz")
-            with requests.get(f"{self.download_url}{self.download_name}.gz", stream=True) as request:
-                with open(self.download_file, 'wb') as file:
-                    shutil.copyfileobj(request.raw, file)
-        if not os.path.isfile(self.unzipped_file):
-            self.logger.info("Extracting gz...")
-            with gzip.open(self.download_file, 'rb') as gzip_file:
-                with open(self.unzipped_file, 'wb') as out_file:
-                    shutil.copyfileobj(gzip_file, out_file)
-
-        if not os.path.isfile(self.city_file):
-            if not os.path.isdir(f"{self.unzipped_file}_extracts"):
-                os.mkdir(f"{self.unzipped_file}_extracts")
-            self.logger.info(f"Extracting {self.city} from Kontur data...")
-            gdal.UseExceptions()
-            # this does the same as ogr2ogr
-            # https://gdal.org/python/osgeo.gdal-module.html#VectorTranslateOptions
-            # we must specify filter SRS, since the geopackage is in 3857
-            city_data = gdal.VectorTranslate(
-                self.city_file,
-                self.unzipped_file,
-                spatFilter=self.bbox,
-                spatSRS="EPSG:4326"
-            )
-            # we must dereference the data for the file actually to be written
-            # https://gdal.org/api/python_gotchas.html#saving-and-closing-datasets-datasources
-            del city_data
+    @classmethod
+    def source(cls, city: str, parameters: Dict, logger: Logger) -> Dict:
+        return {"url": f"{cls.download_url}{cls.download_name}"}
+
+    @classmethod
+    def import_city(cls, slug: str, city: str, bbox: List[float], logger: Logger, telemetry: Telemetry, engine: Engine,
+                    parameters: Dict):
+        logger.info(f"--- Importing Kontur population data for {city} ---")
+        cls(slug, city, bbox, logger, telemetry, engine).run()
+
+    @classmethod
+    def partition_path(cls, cell: int) -> str:
+        return os.path.join(cls.partitions_path, f"{cell:x}.parquet")
+
+    @classmethod
+    def prepared(cls, parameters: Optional[Dict] = None) -> bool:
+        """Returns whether the global data has been partitioned already."""
+        return os.path.isdir(cls.partitions_path)
+
+    @classmethod
+    def prepare(cls, logger: Logger, telemetry: Telemetry, parameters: Optional[Dict] = None):
+        """Downloads the global Kontur data and partitions it by H3 cell, unless we have it already."""
+        # other processes may be preparing the data at the same time, the first one does it
+        with locked(cls.partitions_path):
+            with telemetry.stage("download", "kontur") as metric:
+                if cls.prepared():
+                    logger.info("Found saved Kontur data...")
+                else:
+                    metric.bytes_downloaded = download(f"{cls.download_url}{cls.download_name}.gz",
+                                                       cls.download_file, logger)
+
+            with telemetry.stage("extract", "kontur") as metric:
+                if cls.prepared():
+                    return
+                # sqlite can't read the compressed geopackage, so it is unzipped. The
+                # geopackage is only needed until it is partitioned.
+                try:
+                    logger.info("Extracting gz...")
+                    with gzip.open(cls.download_file, 'rb') as gzip_file:
+                        with open(cls.unzipped_file, 'wb') as out_file:
+                            shutil.copyfileobj(gzip_file, out_file)
+                    logger.info("Partitioning Kontur data...")
+                    metric.rows_in = cls.partition(logger)
+                finally:
+                    if os.path.isfile(cls.unzipped_file):
+                        os.remove(cls.unzipped_file)
+
+    @classmethod
+    def partition(cls, logger: Logger) -> int:
+        """Saves the hexes of the geopackage in a parquet file per parent cell, and returns the number of hexes.
+
+        Call this holding the lock of the partitions, see prepare.
+        """
+        # the geopackage is an sqlite database. The polygons are not needed, the centers of the hexes
+        # are the centers of their envelopes in the spatial index of the geopackage.
+        connection = sqlite3.connect(cls.unzipped_file)
+        try:
+            table, geometry_column, srid = connection.execute(
+                "SELECT table_name, column_name, srs_id FROM gpkg_geometry_columns"
+            ).fetchone()
+            rtree = f"rtree_{table}_{geometry_column}"
+            has_rtree = connection.execute(
+                "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (rtree,)
+            ).fetchone()[0]
+            if has_rtree:
+                cursor = connection.execute(
+                    f'SELECT h3, population, (minx + maxx) / 2, (miny + maxy) / 2 FROM "{table}" '
+                    f'JOIN "{rtree}" ON "{rtree}".id = "{table}".rowid'
+                )
+            else:
+                cursor = connection.execute(f'SELECT h3, population, NULL, NULL FROM "{table}"')
+            cells, populations, xs, ys = [], [], [], []
+            while True:
+                rows = cursor.fetchmany(CHUNK_ROWS)
+                if not rows:
+                    break
+                h3s, chunk_populations, chunk_xs, chunk_ys = zip(*rows)
+                cells.append(np.array([int(h3, 16) for h3 in h3s], dtype=np.int64))
+                populations.append(np.array(chunk_populations, dtype=np.float64))
+                xs.append(np.array(chunk_xs, dtype=np.float64))
+                ys.append(np.array(chunk_ys, dtype=np.float64))
+        finally:
+            connection.close()
+        cells = np.concatenate(cells)
+        populations = np.concatenate(populations)
+        if has_rtree:
+            xs, ys = Transformer.from_crs(srid, 4326, always_xy=True).transform(np.concatenate(xs), np.concatenate(ys))
         else:
-            self.logger.info(f"Found geopackage for {self.city}...")
-        self.logger.info(f"Reading Kontur data for {self.city}...")
-        points_to_save = {}
-        for layer_name in fiona.listlayers(self.city_file):
-            with fiona.open(self.city_file, layer=layer_name) as source:
-                for record in source:
-                    polygon = Polygon(record["geometry"]["coordinates"][0])
-                    # Kontur records are saved per resolution=8 H3 hex
-                    # We only need centroids. Note that these cannot be used for
-                    # analyses at resolution 9 or above as such: data would
-                    # be mapped to the central hex instead of spread out across seven.
-                    # TODO: should we save polygons, to allow high resolution analyses?
-                    geom = from_shape(polygon.centroid, srid=3857)
-                    properties = record["properties"]
-                    hex_id = record["id"]
-                    points_to_save[hex_id] = KonturPoint(
-                        hex_id=hex_id, properties=properties, geom=geom
-                    )
-        self.logger.info(f"Saving {len(points_to_save)} Kontur points...")
-        self.session.bulk_save_objects(points_to_save.values())
-        self.session.commit()
+            logger.info("Kontur geopackage has no spatial index, calculating the centers of the hexes...")
+            xs, ys = centroids(cells)
+
+        # write the files to a temporary directory, so a crash doesn't leave a partial store
+        temp_path = f"{cls.partitions_path}.tmp"
+        if os.path.isdir(temp_path):
+            shutil.rmtree(temp_path)
+        os.mkdir(temp_path)
+        parents = parent(cells, PARTITION_RESOLUTION)
+        order = np.argsort(parents, kind="stable")
+        partitions, starts = np.unique(parents[order], return_index=True)
+        for cell, indices in zip(partitions, np.split(order, starts[1:])):
+            table = pa.table({
+                "hex_id": cells[indices], "population": populations[indices], "x": xs[indices], "y": ys[indices]
+            })
+            pq.write_table(table, os.path.join(temp_path, f"{int(cell):x}.parquet"))
+        os.rename(temp_path, cls.partitions_path)
+        logger.info(f"Saved {len(cells)} Kontur hexes in {len(partitions)} partitions")
+        return len(cells)
+
+    def run(self):
+        self.prepare(self.logger, self.telemetry)
+
+        # the points are read a partition at a time while saving
+        self.logger.info(f"Saving Kontur data for {self.city}...")
+        load_table(self.engine, KonturPoint, self.frames(), self.logger, self.telemetry, "kontur", srid=4326,
+                   copy=copy_frames)
+
+    def frames(self) -> Iterator[DataFrame]:
+        """Reads the Kontur hexes of the city as points, a partition at a time."""
+        minx, miny, maxx, maxy = self.bbox
+        paths = [self.partition_path(cell) for cell in covering(self.bbox, PARTITION_RESOLUTION)]
+        # there is no file if there are no people in the cell
+        paths = [path for path in paths if os.path.isfile(path)]
+        self.logger.info(f"Reading {len(paths)} Kontur partitions for {self.city}...")
+        for path in paths:
+            hexes = pq.read_table(path).to_pandas()
+            # Kontur records are saved per resolution=8 H3 hex
+            # We only need centroids. Note that these cannot be used for
+            # analyses at resolution 9 or above as such: data would
+            # be mapped to the central hex instead of spread out across seven.
+            # TODO: should we save polygons, to allow high resolution analyses?
+            if "x" not in hexes:
+                # partitioned before the centers were saved
+                hexes["x"], hexes["y"] = centroids(hexes["hex_id"].to_numpy())
+            hexes = hexes[hexes["x"].between(minx, maxx) & hexes["y"].between(miny, maxy)]
+            if hexes.empty:
+                continue
+            if H3_RESOLUTION <= KONTUR_RESOLUTION:
+                # the loader doesn't have to hash the points, the cells are known
+                hexes = hexes.assign(h3_cell=parent(hexes["hex_id"].to_numpy(), H3_RESOLUTION))
+            # the properties are json already, missing populations are null
+            properties = DataFrame({
+                "h3": hexes["hex_id"].map("{:x}".format).to_numpy(),
+                "population": hexes["population"].to_numpy()
+            }).to_json(orient="records", lines=True).splitlines()
+            yield hexes.drop(columns="population").assign(properties=properties)
 
 
 if __name__ == "__main__":
@@ -1,124 +1,263 @@
 import argparse
+import itertools
 import logging
 from logging import Logger
 import os
 import sys
-import requests
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import shapefile
 import shutil
 import zipfile
-from ipygis import get_connection_url
-from osgeo import gdal
-from shapely.geometry import Polygon
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from typing import List
-from geoalchemy2.shape import from_shape
+from pandas import DataFrame
+from sqlalchemy.engine.base import Engine
+from typing import Dict, Iterator, List, Optional, Tuple
 from slugify import slugify
 
 # test simple import now, convert to module later
 sys.path.insert(0, "..")
+from db import get_engine, with_schema
+from download import download_all, locked
+from loader import copy_frames, load_table
 from models import OoklaPoint
+from quadkeys import centers, covering, parent
+from telemetry import Telemetry
 
 DATA_PATH = "data"
+# Zoom of the partitions. A city only has to read the partitions around it.
+PARTITION_ZOOM = 8
+# Records to read from the shapefile at a time
+CHUNK_ROWS = 1000000
+# Tiles with fewer devices are not imported
+MIN_DEVICES = 3
+# Ookla publishes tiles of fixed and mobile networks every quarter, as "2021-1"
+TYPES = ("fixed", "mobile")
+DEFAULT_TYPES = ["fixed"]
+DEFAULT_QUARTERS = ["2021-1"]
+
+
+def parse_quarters(quarters: List[str]) -> List[str]:
+    """Returns the quarters, with ranges like "2020-1:2020-4" expanded."""
+    parsed = []
+    for quarter in quarters:
+        first, _, last = quarter.partition(":")
+        year, number = _quarter(first)
+        last_year, last_number = _quarter(last or first)
+        while (year, number) <= (last_year, last_number):
+            parsed.append(f"{year}-{number}")
+            year, number = (year + 1, 1) if number == 4 else (year, number + 1)
+    return parsed
+
+
+def _quarter(quarter: str) -> Tuple[int, int]:
+    year, _, number = quarter.partition("-")
+    if not year.isdigit() or number not in ("1", "2", "3", "4"):
+        raise AssertionError(f"Quarters must be given as year-quarter, e.g. 2021-1, not {quarter}.")
+    return int(year), int(number)
 
 
 class OoklaImporter(object):
+    # the data sources also identify the imported data version
+    download_url = "https://ookla-open-data.s3.amazonaws.com/shapefiles/performance/"
+    # data should be stored one directory level above importers
+    data_path = os.path.join(os.path.dirname(os.path.dirname(__loader__.path)), DATA_PATH)
 
-    def __init__(self, slug: str, city: str, bbox: List[float], logger: Logger):
+    def __init__(self, slug: str, city: str, bbox: List[float], logger: Logger, telemetry: Optional[Telemetry] = None,
+                 engine: Optional[Engine] = None, parameters: Optional[Dict] = None):
         if not city or not slug:
             raise AssertionError("You must specify the city name.")
         # BBOX (minx, miny, maxx, maxy)
         self.bbox = bbox
         self.city = city
         self.logger = logger
-        self.download_url = "https://ookla-open-data.s3.amazonaws.com/shapefiles/performance/type=fixed/year=2021/quarter=1/"
-        self.download_name = "2021-01-01_performance_fixed_tiles"
-
-        # data should be stored one directory level above importers
-        self.unzipped_path = os.path.join(
-            os.path.dirname(os.path.dirname(__loader__.path)),
-            DATA_PATH,
-            self.download_name
-        )
-        self.download_file = self.unzipped_path + ".zip"
-        self.city_file = f"{self.unzipped_path}/{self.city}.shp"
-
-        sql_url = get_connection_url(dbname="geoviz")
-        engine = create_engine(sql_url)
-        schema_engine = engine.execution_options(
-            schema_translate_map={'schema': slug}
-        )
-        self.session = sessionmaker(bind=schema_engine)()
-        OoklaPoint.__table__.drop(schema_engine, checkfirst=True)
-        OoklaPoint.__table__.create(schema_engine)
+        self.telemetry = telemetry or Telemetry(logger)
+        # {types: [fixed, mobile], quarters: [2020-1:2021-4]}
+        self.parameters = parameters or {}
 
-    def run(self):
-        if os.path.isfile(self.download_file):
-            self.logger.info("Found saved Ookla data...")
-        else:
-            self.logger.info("Downloading Ookla data...")
-            self.logger.info(f"{self.download_url}{self.download_name}.zip")
-            with requests.get(f"{self.download_url}{self.download_name}.zip", stream=True) as request:
-                with open(self.download_file, 'wb') as file:
-                    shutil.copyfileobj(request.raw, file)
-        if not os.path.isdir(self.unzipped_path) or not os.path.isfile(f"{self.unzipped_path}/gps_fixed_tiles.shp"):
-            self.logger.info("Extracting zip...")
-            with zipfile.ZipFile(self.download_file, 'r') as zip_ref:
-                zip_ref.extractall(self.unzipped_path)
-
-        if not os.path.isfile(self.city_file):
-            self.logger.info(f"Extracting {self.city} from Ookla data...")
-            gdal.UseExceptions()
-            # this does the same as ogr2ogr
-            # https://gdal.org/python/osgeo.gdal-module.html#VectorTranslateOptions
-            city_data = gdal.VectorTranslate(
-                self.city_file,
-                f"{self.unzipped_path}/gps_fixed_tiles.shp",
-                spatFilter=self.bbox
+        # share the connection pool of the import run
+        schema_engine = with_schema(engine or get_engine(), slug)
+        self.engine = schema_engine
+        # the table is replaced once the new data is loaded
+        OoklaPoint.__table__.create(schema_engine, checkfirst=True)
+
+    @classmethod
+    def source(cls, city: str, parameters: Dict, logger: Logger) -> Dict:
+        return {"urls": [cls.source_url(*source) for source in cls.sources(parameters)]}
+
+    @classmethod
+    def import_city(cls, slug: str, city: str, bbox: List[float], logger: Logger, telemetry: Telemetry, engine: Engine,
+                    parameters: Dict):
+        logger.info(f"--- Importing Ookla speedtest data for {city} ---")
+        cls(slug, city, bbox, logger, telemetry, engine, parameters).run()
+
+    @classmethod
+    def sources(cls, parameters: Dict) -> List[Tuple[str, str]]:
+        """Returns the types and quarters to import."""
+        types = parameters.get("types") or DEFAULT_TYPES
+        for tile_type in types:
+            if tile_type not in TYPES:
+                raise AssertionError(f"Ookla tile type must be one of {TYPES}, not {tile_type}.")
+        quarters = parse_quarters(parameters.get("quarters") or DEFAULT_QUARTERS)
+        return [(tile_type, quarter) for tile_type in types for quarter in quarters]
+
+    @staticmethod
+    def quarter_start(quarter: str) -> str:
+        year, number = _quarter(quarter)
+        return f"{year}-{3 * number - 2:02d}-01"
+
+    @classmethod
+    def source_url(cls, tile_type: str, quarter: str) -> str:
+        year, number = _quarter(quarter)
+        name = f"{cls.quarter_start(quarter)}_performance_{tile_type}_tiles"
+        return f"{cls.download_url}type={tile_type}/year={year}/quarter={number}/{name}.zip"
+
+    @classmethod
+    def source_path(cls, tile_type: str, quarter: str) -> str:
+        return os.path.join(cls.data_path, f"{cls.quarter_start(quarter)}_performance_{tile_type}_tiles")
+
+    @classmethod
+    def partition_path(cls, tile_type: str, quarter: str, quadkey: int) -> str:
+        # the global tiles are saved in a parquet file per quadkey at PARTITION_ZOOM
+        return os.path.join(f"{cls.source_path(tile_type, quarter)}_partitions",
+                            f"{quadkey:0{PARTITION_ZOOM}d}.parquet")
+
+    @classmethod
+    def prepared(cls, parameters: Optional[Dict] = None) -> bool:
+        """Returns whether the global tiles of all the quarters have been partitioned already."""
+        sources = cls.sources(parameters or {})
+        return all(os.path.isdir(f"{cls.source_path(*source)}_partitions") for source in sources)
+
+    @classmethod
+    def prepare(cls, logger: Logger, telemetry: Telemetry, parameters: Optional[Dict] = None):
+        """Downloads the global Ookla tiles and partitions them by quadkey, unless we have them already."""
+        sources = [
+            source for source in cls.sources(parameters or {})
+            if not os.path.isdir(f"{cls.source_path(*source)}_partitions")
+        ]
+        if not sources:
+            logger.info("Found saved Ookla data...")
+            return
+        with telemetry.stage("download", "ookla") as metric:
+            logger.info(f"Downloading {len(sources)} Ookla files...")
+            metric.bytes_downloaded = download_all(
+                {cls.source_url(*source): f"{cls.source_path(*source)}.zip" for source in sources}, logger
             )
-            self.logger.info(city_data)
-            # we must dereference the data for the file actually to be written
-            # https://gdal.org/api/python_gotchas.html#saving-and-closing-datasets-datasources
-            del city_data
-        else:
-            self.logger.info(f"Found shapefile for {self.city}...")
-        self.logger.info(f"Reading Ookla data for {self.city}...")
-        with shapefile.Reader(self.city_file) as shapes:
-            points_to_save = {}
-            for shaperecord in shapes.shapeRecords():
+        with telemetry.stage("extract", "ookla") as metric:
+            metric.rows_in = 0
+            for source in sources:
+                # other processes may be partitioning the same quarter, the first one does it
+                with locked(f"{cls.source_path(*source)}_partitions"):
+                    if not os.path.isdir(f"{cls.source_path(*source)}_partitions"):
+                        metric.rows_in += cls.partition(*source, logger)
+
+    @classmethod
+    def partition(cls, tile_type: str, quarter: str, logger: Logger) -> int:
+        """Saves the tiles of the quarter in a parquet file per quadkey prefix, and returns the number of tiles.
+
+        Call this holding the lock of the partitions, see prepare.
+        """
+        unzipped_path = cls.source_path(tile_type, quarter)
+        partitions_path = f"{unzipped_path}_partitions"
+        # the shapefile is only needed until it is partitioned
+        try:
+            logger.info(f"Extracting Ookla {tile_type} tiles of {quarter}...")
+            with zipfile.ZipFile(f"{unzipped_path}.zip", 'r') as zip_ref:
+                zip_ref.extractall(unzipped_path)
+            # only the attributes are read, the tile polygons are known from the quadkeys
+            with shapefile.Reader(os.path.join(unzipped_path, f"gps_{tile_type}_tiles.shp")) as shapes:
+                fields = [field[0] for field in shapes.fields[1:]]
+                records = shapes.iterRecords()
+                chunks = []
+                while True:
+                    chunk = DataFrame(itertools.islice(records, CHUNK_ROWS), columns=fields)
+                    if chunk.empty:
+                        break
+                    chunk["quadkey"] = chunk["quadkey"].astype(np.int64)
+                    chunks.append(chunk)
+            tiles = pd.concat(chunks, ignore_index=True)
+        finally:
+            if os.path.isdir(unzipped_path):
+                shutil.rmtree(unzipped_path)
+
+        # write the files to a temporary directory, so a crash doesn't leave a partial store
+        temp_path = f"{partitions_path}.tmp"
+        if os.path.isdir(temp_path):
+            shutil.rmtree(temp_path)
+        os.mkdir(temp_path)
+        prefixes = parent(tiles["quadkey"].to_numpy(), PARTITION_ZOOM)
+        for prefix, partition in tiles.groupby(prefixes, sort=False):
+            pq.write_table(
+                pa.Table.from_pandas(partition, preserve_index=False),
+                os.path.join(temp_path, f"{prefix:0{PARTITION_ZOOM}d}.parquet")
+            )
+        os.rename(temp_path, partitions_path)
+        logger.info(f"Saved {len(tiles)} Ookla tiles in {len(np.unique(prefixes))} partitions")
+        return len(tiles)
+
+    def run(self):
+        self.prepare(self.logger, self.telemetry, self.parameters)
+
+        # the points are read a partition at a time while saving
+        self.logger.info(f"Saving Ookla data for {self.city}...")
+        load_table(self.engine, OoklaPoint, self.frames(), self.logger, self.telemetry, "ookla", srid=4326,
+                   copy=copy_frames)
+
+    def frames(self) -> Iterator[DataFrame]:
+        """Reads the Ookla tiles of the city as points, a partition at a time."""
+        minx, miny, maxx, maxy = self.bbox
+        quadkeys = covering(self.bbox, PARTITION_ZOOM)
+        tiles_in_bbox = 0
+        tiles_saved = 0
+        for tile_type, quarter in self.sources(self.parameters):
+            paths = [self.partition_path(tile_type, quarter, quadkey) for quadkey in quadkeys]
+            # there is no file if there are no tests in the tile
+            paths = [path for path in paths if os.path.isfile(path)]
+            self.logger.info(f"Reading {len(paths)} Ookla {tile_type} partitions of {quarter} for {self.city}...")
+            for path in paths:
+                tiles = pq.read_table(path).to_pandas()
                 # Ookla records are saved per tile, we only need centroids.
                 # Note that these cannot be used for analyses at resolution 9
                 # or above as such: not all hexes would contain a tile centroid.
                 # TODO: should we save polygons, to allow high resolution analyses?
-                polygon = Polygon(shaperecord.shape.points)
-                geom = from_shape(polygon.centroid, srid=4326)
-                properties = shaperecord.record.as_dict()
-                if properties["devices"] < 3:
-                    # ignore polygons with only one or two devices
-                    # outliers tell nothing of average speed in the area
-                    # e.g. single people on an island or in the woods who have
-                    # paid for fibre cable
+                xs, ys = centers(tiles["quadkey"].to_numpy())
+                in_bbox = (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)
+                # ignore polygons with only one or two devices
+                # outliers tell nothing of average speed in the area
+                # e.g. single people on an island or in the woods who have
+                # paid for fibre cable
+                keep = in_bbox & (tiles["devices"].to_numpy() >= MIN_DEVICES)
+                tiles_in_bbox += int(in_bbox.sum())
+                tiles_saved += int(keep.sum())
+                tiles = tiles[keep]
+                if tiles.empty:
                     continue
-                quadkey_id = properties.pop("quadkey")
-                points_to_save[quadkey_id] = OoklaPoint(
-                    quadkey_id=quadkey_id, properties=properties, geom=geom
-                )
-                self.logger.info(geom)
-                self.logger.info(properties)
-        self.logger.info(f"Saving {len(points_to_save)} Ookla points...")
-        self.session.bulk_save_objects(points_to_save.values())
-        self.session.commit()
+                yield DataFrame({
+                    "quadkey_id": tiles["quadkey"].to_numpy(),
+                    "type": tile_type,
+                    "quarter": self.quarter_start(quarter),
+                    # the properties are json already
+                    "properties": tiles.drop(columns="quadkey").to_json(orient="records", lines=True).splitlines(),
+                    "x": xs[keep],
+                    "y": ys[keep]
+                })
+        self.logger.info(f"Found {tiles_in_bbox} Ookla tiles for {self.city}, "
+                         f"skipped {tiles_in_bbox - tiles_saved} with less than {MIN_DEVICES} devices")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Import Ookla speedtest data for given city")
     parser.add_argument("--city", default="Helsinki", help="City to import")
     parser.add_argument("--bbox", default=(24.82345, 60.14084, 25.06404, 60.29496))
+    parser.add_argument("--quarters", default=" ".join(DEFAULT_QUARTERS),
+                        help="Quarters to import, e.g. \"2020-1:2021-4\"")
+    parser.add_argument("--types", default=" ".join(DEFAULT_TYPES), help="Tile types to import, e.g. \"fixed mobile\"")
     args = vars(parser.parse_args())
     arg_city = args.get("city", None)
     arg_slug = slugify(arg_city)
     arg_bbox = args.get("bbox", None)
     arg_bbox = list(map(float, arg_bbox.split(", ")))
-    importer = OoklaImporter(arg_slug, arg_city, arg_bbox, logging.getLogger("import"))
+    arg_parameters = {"quarters": args["quarters"].split(), "types": args["types"].split()}
+    importer = OoklaImporter(arg_slug, arg_city, arg_bbox, logging.getLogger("import"), parameters=arg_parameters)
     importer.run()
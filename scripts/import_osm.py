@@ -5,28 +5,31 @@ import sys
 
 import osmnx as ox
 from geopandas import GeoDataFrame
-from ipygis import get_connection_url
-from sqlalchemy import create_engine
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.schema import CreateSchema
-from geoalchemy2 import Geometry, WKTElement
-from typing import Dict
+from typing import Dict, List, Optional
 
 # test simple import now, convert to module later
 sys.path.insert(0, "..")
+from db import get_engine, with_schema
+from loader import load_table
 from models import OSMPoint
-from osm_tags import tags_to_filter
+from osm_tags import classify, save_tags_hash, tags_to_download
+from telemetry import Telemetry
 
 
 class OsmImporter(object):
     """Import OSM data to PostGIS using Overpass API."""
 
-    def __init__(self, args: Dict, logger: Logger):
+    def __init__(self, args: Dict, logger: Logger, telemetry: Optional[Telemetry] = None,
+                 engine: Optional[Engine] = None):
         args = self._parse_args(args)
         self.slug = args["slug"]
         self.bbox = args["bbox"]
-        self._engine = self._create_engine()
+        # share the connection pool of the import run
+        self._engine = with_schema(engine or get_engine(), self.slug)
         self.logger = logger
+        self.telemetry = telemetry or Telemetry(logger)
         # configure the osmnx importer to not timeout even with very dense areas
         # in such cases, 50x50 km square contains too much data
         ox.utils.config(max_query_area_size=25 * 1000 * 25 * 1000)
@@ -45,45 +48,60 @@ class OsmImporter(object):
         minx, miny, maxx, maxy = map(float, arg_bbox.split(", "))
         return {"slug": slug, "bbox": (minx, miny, maxx, maxy)}
 
-    def _create_engine(self) -> Engine:
-        """Sets up and returns a DB engine."""
-        sql_url = get_connection_url(dbname="geoviz")
-        engine = create_engine(sql_url)
-        return engine.execution_options(
-            schema_translate_map={"schema": self.slug}
-        )
+    @classmethod
+    def source(cls, city: str, parameters: Dict, logger: Logger) -> Dict:
+        # changing the tags imports OSM again
+        return {"tags": tags_to_download}
+
+    @classmethod
+    def import_city(cls, slug: str, city: str, bbox: List[float], logger: Logger, telemetry: Telemetry, engine: Engine,
+                    parameters: Dict):
+        logger.info(f"--- Importing OSM data for {city} ---")
+        osm_bbox = ", ".join([str(coord) for coord in bbox])
+        cls({"slug": slug, "bbox": osm_bbox}, logger, telemetry, engine).run()
 
     def run(self):
         self._initialise_db()
-        self.logger.info("Fetching OSM data from Overpass API...")
-        pois = self._get_amenities()
-        self.logger.info(f"Found {pois.shape[0]} POIs, processing...")
-
-        pois = pois.to_crs(epsg=3035)
-        # convert non-nodes to nodes
-        pois.geometry = pois.centroid
-        pois = pois.to_crs(epsg=4326)
-
-        pois = pois.reset_index()
-
-        # we have to make sure columns don't exist before renaming
-        pois.drop(labels=["node_id", "geom"], axis=1, errors='ignore', inplace=True)
-        # TODO: this saves also way ids and relation ids as node ids!!
-        pois = pois.rename(columns={"osmid": "node_id"})
-        pois = pois.rename(columns={"geometry": "geom"})
-        pois = pois.set_index("node_id")
-        # node_id is no longer a column, it's the index
-        tag_columns = list(pois.columns)
-        tag_columns.remove("geom")
-        pois["geom"] = pois["geom"].apply(lambda geom: WKTElement(geom.wkt, srid=4326))
-
-        pois["tags"] = [row.dropna().to_json()
-                        for idx, row in pois[tag_columns].iterrows()]
-        pois = pois.drop(tag_columns, axis=1)
-        self.logger.info(f"Importing {pois.shape[0]} POIs to database in schema {self.slug}")
+        with self.telemetry.stage("download", "osm") as metric:
+            self.logger.info("Fetching OSM data from Overpass API...")
+            pois = self._get_amenities()
+            metric.rows_out = pois.shape[0]
+
+        with self.telemetry.stage("transform", "osm") as metric:
+            self.logger.info(f"Found {pois.shape[0]} POIs, processing...")
+            metric.rows_in = pois.shape[0]
+
+            pois = pois.to_crs(epsg=3035)
+            # convert non-nodes to nodes
+            pois.geometry = pois.centroid
+            pois = pois.to_crs(epsg=4326)
+
+            pois = pois.reset_index()
+
+            # we have to make sure columns don't exist before renaming
+            pois.drop(labels=["node_id", "geom"], axis=1, errors='ignore', inplace=True)
+            # TODO: this saves also way ids and relation ids as node ids!!
+            pois = pois.rename(columns={"osmid": "node_id"})
+            pois = pois.rename(columns={"geometry": "geom"})
+            pois = pois.set_index("node_id")
+            # node_id is no longer a column, it's the index
+            tag_columns = list(pois.columns)
+            tag_columns.remove("geom")
+
+            pois["category"] = classify(pois[tag_columns])
+            pois["tags"] = [row.dropna().to_json()
+                            for idx, row in pois[tag_columns].iterrows()]
+            pois = pois.drop(tag_columns, axis=1)
+            metric.rows_out = pois.shape[0]
 
-        pois.to_sql(name=OSMPoint.__tablename__, con=self._engine, schema=self.slug, if_exists="append",
-                    dtype={"geom": Geometry(geometry_type="POINT", srid=4326)})
+        self.logger.info(f"Importing {pois.shape[0]} POIs to database in schema {self.slug}")
+        # tags are json already
+        rows = (
+            {"node_id": node_id, "tags": tags, "category": category, "geom": geom}
+            for node_id, tags, category, geom in zip(pois.index, pois["tags"], pois["category"], pois["geom"])
+        )
+        load_table(self._engine, OSMPoint, rows, self.logger, self.telemetry, "osm", srid=4326)
+        save_tags_hash(self._engine)
 
     def _initialise_db(self) -> None:
         """Initialises OSM points table and returns a new DB Session."""
@@ -93,12 +111,12 @@ class OsmImporter(object):
         if not self._engine.dialect.has_schema(self._engine, self.slug):
             self._engine.execute(CreateSchema(self.slug))
 
-        OSMPoint.__table__.drop(self._engine, checkfirst=True)
-        OSMPoint.__table__.create(self._engine)
+        # the table is replaced once the new data is loaded
+        OSMPoint.__table__.create(self._engine, checkfirst=True)
 
     def _get_amenities(self) -> GeoDataFrame:
         (minx, miny, maxx, maxy) = self.bbox
-        return ox.geometries.geometries_from_bbox(maxy, miny, maxx, minx, tags=tags_to_filter)
+        return ox.geometries.geometries_from_bbox(maxy, miny, maxx, minx, tags=tags_to_download)
 
 
 if __name__ == "__main__":
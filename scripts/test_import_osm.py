@@ -43,7 +43,7 @@ def test_db_init(db_engine, helsinki_importer):
     insp = inspect(db_engine)
     assert insp.has_table(table_name, schema=helsinki_importer.slug)
     columns = insp.get_columns(table_name, schema=helsinki_importer.slug)
-    assert len(columns) == 3
+    assert len(columns) == 5
 
     session = sessionmaker(bind=db_engine.execution_options(schema_translate_map={"schema": helsinki_importer.slug}))()
     assert session.query(OSMPoint).first() is None
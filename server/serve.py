@@ -1,22 +1,21 @@
 import os
 import secrets
-import subprocess
 import sys
-from dotenv import find_dotenv, load_dotenv, set_key
+from typing import Dict
+from dotenv import load_dotenv
 from flask import Flask, redirect, render_template, request, send_from_directory
 from flask_httpauth import HTTPBasicAuth
 from slugify import slugify
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.schema import DropSchema
-from time import sleep
 from werkzeug.security import check_password_hash
 
 from forms import AnalysisForm
 
 # test simple import now, convert to module later
 sys.path.insert(0, "..")
-from models import Analysis
+from jobs import cancel, delete_analysis, enqueue, queued
+from models import Analysis, Job
 from scripts.import_gtfs import GTFS_DATASETS
 
 app = Flask(__name__, static_url_path='')
@@ -37,8 +36,8 @@ with engine.connect() as conn:
     conn.execute("CREATE EXTENSION IF NOT EXISTS postgis")
 session = sessionmaker(bind=engine)()
 Analysis.__table__.create(engine, checkfirst=True)
-# store the running processes
-processes = {}
+# imports are run by worker.py processes, we only queue them here
+Job.__table__.create(engine, checkfirst=True)
 
 
 @auth.verify_password
@@ -123,14 +122,9 @@ def analysis_for_city(city):
     analysis = session.query(Analysis).filter(Analysis.slug == slug).first()
     # cancel an analysis
     if request.method == 'DELETE':
-        # is SIGTERM enough?
-        if slug in processes:
-            print('process found, terminating')
-            processes[slug].terminate()
-            del processes[slug]
-        session.delete(analysis)
-        session.commit()
-        engine.execute(DropSchema(slug, cascade=True))
+        # the worker running the import will terminate it, and delete the data once it has stopped
+        if not cancel(session, slug):
+            delete_analysis(session, slug)
         # TODO: delete also result file if present?
         return ('', 200)
     if analysis:
@@ -138,17 +132,15 @@ def analysis_for_city(city):
     return('', 404)
 
 
-def save_apikeys(form: AnalysisForm):
-    # TODO: set_key will not work inside the container. figure out how to make the changes permanent
-    if form.flickr_apikey.data:
-        os.environ["FLICKR_API_KEY"] = form.flickr_apikey.data
-        # set_key(find_dotenv(), "FLICKR_API_KEY", form.flickr_apikey.data)
-    if form.flickr_secret.data:
-        os.environ["FLICKR_SECRET"] = form.flickr_secret.data
-        # set_key(find_dotenv(), "FLICKR_SECRET", form.flickr_secret.data)
-    if form.mapbox_apikey.data:
-        os.environ["MAPBOX_API_KEY"] = form.mapbox_apikey.data
-        # set_key(find_dotenv(), "FLICKR_SECRET", form.mapbox_apikey.data)
+def read_apikeys(form: AnalysisForm) -> Dict[str, str]:
+    """Returns the API keys entered in the form, to be set in the environment of the import."""
+    # the imports run in worker processes, so the keys are passed with the job
+    keys = {
+        "FLICKR_API_KEY": form.flickr_apikey.data,
+        "FLICKR_SECRET": form.flickr_secret.data,
+        "MAPBOX_API_KEY": form.mapbox_apikey.data,
+    }
+    return {name: key for name, key in keys.items() if key}
 
 
 @app.route('/', methods=["GET", "POST"])
@@ -157,7 +149,6 @@ def home():
     # our fancy UI
     form = AnalysisForm()
     if form.validate_on_submit():
-        save_apikeys(form)
         city_name = form.bbox.form.city.data
 
         # Starting from WTForms 3.0, empty string fields are None.
@@ -166,10 +157,9 @@ def home():
         bbox_string = " ".join(form.bbox.form.bbox.data.split(","))
         dataset_string = " ".join(form.dataset_selection.data)
 
-        # this should be safe, as shell injections are not possible with Popen
-        # and Flask has sanitized the field inputs?
-        process = subprocess.Popen([
-            "../import.py",
+        # import.py arguments are passed to Popen as a list by the worker,
+        # so shell injections are not possible
+        enqueue(session, city_name, [
             city_name,
             "--datasets",
             dataset_string,
@@ -179,9 +169,7 @@ def home():
             gtfs_urls,
             "--export",
             "--delete"  # by default, delete imported data after analysis since the UI won't need it
-        ])
-        processes[slugify(city_name)] = process
-        sleep(3.0)
+        ], read_apikeys(form))
         return redirect('/')
     unviewed_analyses = session.query(Analysis).filter(Analysis.viewed.is_(False)).all()
     running_analyses = session.query(Analysis).filter(Analysis.finish_time.is_(None)).all()
@@ -191,6 +179,7 @@ def home():
         description="Import urban datasets and run analyses.",
         form=form,
         running=running_analyses,
+        queued=queued(session),
         analyses=unviewed_analyses
     )
 
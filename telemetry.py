@@ -0,0 +1,101 @@
+import datetime
+import threading
+import time
+from contextlib import contextmanager
+from logging import Logger
+from typing import Optional
+
+import psutil
+from sqlalchemy.engine.base import Engine
+from sqlalchemy.orm import Session
+
+from models import StageMetric
+
+# How often to sample memory use while a stage is running, in seconds
+SAMPLE_INTERVAL = 0.5
+
+
+class Telemetry(object):
+    """Measure the stages of an import run and save the metrics for the analysis.
+
+    Metrics are saved once the telemetry is bound to an analysis. Until then,
+    e.g. while geocoding, they are kept in memory. Without an analysis, the
+    metrics are only logged.
+
+    Cpu time and peak memory are measured for the whole process, so they
+    include any other stages running at the same time.
+    """
+
+    def __init__(self, logger: Logger, engine: Optional[Engine] = None, analysis_id: Optional[int] = None):
+        self.logger = logger
+        self.engine = engine
+        self.analysis_id = analysis_id
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def bind(self, engine: Engine, analysis_id: int):
+        """Saves the metrics of this run for the analysis from now on."""
+        with self._lock:
+            self.engine = engine
+            self.analysis_id = analysis_id
+            pending, self._pending = self._pending, []
+        StageMetric.__table__.create(engine, checkfirst=True)
+        for metric in pending:
+            self._save(metric)
+
+    @contextmanager
+    def stage(self, stage: str, dataset: Optional[str] = None):
+        """Measures the stage. Set rows_in, rows_out and bytes_downloaded of the yielded metric."""
+        metric = StageMetric(dataset=dataset, stage=stage, started=datetime.datetime.now())
+        process = psutil.Process()
+        sampler = MemorySampler(process)
+        sampler.start()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield metric
+        finally:
+            metric.wall_time = time.perf_counter() - wall_start
+            metric.cpu_time = time.process_time() - cpu_start
+            metric.peak_rss = sampler.stop()
+            self.logger.info(f"{dataset or 'import'} {stage} took {metric.wall_time:.1f} s, "
+                             f"cpu {metric.cpu_time:.1f} s, peak memory {metric.peak_rss / 1024 / 1024:.0f} MB, "
+                             f"rows in {metric.rows_in}, rows out {metric.rows_out}, "
+                             f"bytes downloaded {metric.bytes_downloaded}")
+            self._save(metric)
+
+    def _save(self, metric: StageMetric):
+        with self._lock:
+            if not self.analysis_id:
+                self._pending.append(metric)
+                return
+        metric.analysis_id = self.analysis_id
+        session = Session(bind=self.engine)
+        try:
+            session.add(metric)
+            session.commit()
+        except Exception as error:
+            # metrics must never break the import
+            session.rollback()
+            self.logger.warning(f"Could not save metrics for {metric.dataset} {metric.stage}: {error!r}")
+        finally:
+            session.close()
+
+
+class MemorySampler(threading.Thread):
+    """Samples the memory use of a process until stopped."""
+
+    def __init__(self, process: psutil.Process):
+        super().__init__(daemon=True)
+        self.process = process
+        self.peak = process.memory_info().rss
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def stop(self) -> int:
+        self._stopped.set()
+        self.join()
+        return max(self.peak, self.process.memory_info().rss)
@@ -0,0 +1,46 @@
+import fcntl
+import hashlib
+import logging
+
+import pytest
+import requests
+
+from download import _check, locked, save_metadata, version
+
+
+def test_check_size_and_md5_etag(tmp_path):
+    path = tmp_path / "tiles.zip"
+    path.write_bytes(b"tiles")
+    etag = hashlib.md5(b"tiles").hexdigest()
+    assert _check(str(path), 5, etag) is None
+    # multipart ETags are no checksums
+    assert _check(str(path), None, "abc-2") is None
+    assert "bytes" in _check(str(path), 6, etag)
+    assert "checksum" in _check(str(path), 5, "0" * 32)
+
+
+def test_locked_excludes_other_holders(tmp_path):
+    path = str(tmp_path / "tiles_partitions")
+    with locked(path):
+        with open(f"{path}.lock") as other:
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    with open(f"{path}.lock") as other:
+        fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_version_without_downloading(tmp_path, monkeypatch):
+    path = str(tmp_path / "gtfs.zip")
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Last-Modified"] = "Mon, 06 Sep 2021 08:00:00 GMT"
+    monkeypatch.setattr(requests, "head", lambda url, **kwargs: response)
+    assert version("http://example.com/gtfs.zip", path, logging.getLogger("test")) == response.headers["Last-Modified"]
+    # the version of the saved file is used if the server is down
+    save_metadata(path, {"etag": '"abc"'})
+
+
+    def unreachable(url, **kwargs):
+        raise requests.ConnectionError()
+    monkeypatch.setattr(requests, "head", unreachable)
+    assert version("http://example.com/gtfs.zip", path, logging.getLogger("test")) == '"abc"'
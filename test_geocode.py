@@ -0,0 +1,80 @@
+import datetime
+import gzip
+import logging
+
+import pytest
+from pytest_postgresql import factories
+from sqlalchemy import create_engine, text
+
+from geocode import Geocoder, normalize, read_places
+from models import GeocodedCity
+
+postgres_external = factories.postgresql_noproc(port=5400, password="postgres")
+postgres = factories.postgresql("postgres_external", dbname="test_geocode")
+
+COLUMNS = ["name", "class", "country", "country_code", "importance", "lon", "lat", "west", "south", "east", "north"]
+PLACES = [
+    ["Helsinki", "boundary", "Finland", "fi", "0.8", "24.94", "60.17", "24.78", "59.92", "25.25", "60.30"],
+    # less important places by the same name are not cached
+    ["helsinki", "place", "Finland", "fi", "0.1", "25.0", "60.0", "24.9", "59.9", "25.1", "60.1"],
+    ["Helsingør", "place", "Denmark", "dk", "0.5", "12.59", "56.03", "12.50", "55.99", "12.65", "56.07"],
+    # no cities
+    ["Helsinki-Vantaa", "aeroway", "Finland", "fi", "0.6", "24.96", "60.32", "24.9", "60.3", "25.0", "60.3"],
+    ["", "place", "Finland", "fi", "0.3", "24.0", "60.0", "24.0", "60.0", "24.0", "60.0"],
+]
+
+
+@pytest.fixture
+def dump_path(tmp_path):
+    path = tmp_path / "geonames.tsv.gz"
+    with gzip.open(path, "wt", encoding="utf-8") as dump:
+        for row in [COLUMNS] + PLACES:
+            dump.write("\t".join(row) + "\n")
+    return str(path)
+
+
+@pytest.fixture(scope="function")
+def geocoder(postgres):
+    """Geocoder using the test database, which never asks any geocoding service."""
+    engine = create_engine('postgresql+psycopg2://', creator=lambda: postgres.cursor().connection)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS postgis"))
+    geocoder = Geocoder(engine, logging.getLogger("test"))
+    geocoder._fetch = lambda city: pytest.fail(f"{city} not found in geocode cache")
+    yield geocoder
+    geocoder.session.close()
+
+
+def test_normalize():
+    assert normalize("  new   York ") == "new york"
+    assert normalize("HELSINKI") == normalize("helsinki")
+
+
+def test_read_places_keeps_most_important(dump_path):
+    places = read_places(dump_path)
+    assert set(places) == {"helsinki", "helsingør"}
+    importance, name, bbox, centroid, country = places["helsinki"]
+    assert (importance, name, country) == (0.8, "Helsinki", "Finland")
+    assert bbox == (24.78, 59.92, 25.25, 60.30)
+    assert centroid == (24.94, 60.17)
+
+
+def test_read_places_in_countries(dump_path):
+    assert set(read_places(dump_path, ["DK"])) == {"helsingør"}
+
+
+def test_prewarm_and_geocode_from_cache(geocoder, dump_path):
+    assert geocoder.prewarm(dump_path) == 2
+    assert geocoder.geocode("  HELSINKI ") == pytest.approx([24.78, 59.92, 25.25, 60.30])
+    cached = geocoder.session.query(GeocodedCity).filter(GeocodedCity.key == "helsinki").one()
+    assert cached.source == "geonames.tsv.gz"
+
+
+def test_expired_cities_are_evicted(geocoder, dump_path):
+    geocoder.prewarm(dump_path)
+    geocoder.session.query(GeocodedCity).filter(GeocodedCity.key == "helsinki").update(
+        {"updated": datetime.datetime.now() - geocoder.ttl - datetime.timedelta(days=1)}
+    )
+    geocoder.session.commit()
+    assert geocoder.evict() == 1
+    assert [city.key for city in geocoder.session.query(GeocodedCity)] == ["helsingør"]
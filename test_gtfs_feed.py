@@ -0,0 +1,85 @@
+import io
+import logging
+import zipfile
+
+import pandas as pd
+import pytest
+
+from gtfs_feed import frequencies, read_feed, seconds, service_dates
+
+FEED = {
+    # the second stop is outside the bbox
+    "stops.txt": "stop_id,stop_name,stop_lat,stop_lon\n"
+                 "a,Inside,60.17,24.94\n"
+                 "b,Outside,61.50,23.76\n",
+    # feeds may have spaces in the header, and one of the times only
+    "stop_times.txt": "trip_id, arrival_time, departure_time, stop_id, stop_sequence\n"
+                      "weekday,07:59:00,08:00:00,a,1\n"
+                      "weekday,09:00:00,09:00:00,b,2\n"
+                      "night,25:10:00,,a,1\n"
+                      "sunday,10:00:00,10:00:00,a,1\n",
+    "trips.txt": "route_id,service_id,trip_id,direction_id\n"
+                 "1,weekdays,weekday,1\n"
+                 "1,weekdays,night,0\n"
+                 "1,sundays,sunday,1\n",
+    # Monday 2021-09-06 to Sunday 2021-09-12
+    "calendar.txt": "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+                    "weekdays,1,1,1,1,1,0,0,20210906,20210912\n"
+                    "sundays,0,0,0,0,0,0,1,20210906,20210912\n",
+    "calendar_dates.txt": "service_id,date,exception_type\n"
+                          "weekdays,20210907,2\n"
+                          "weekdays,20210912,1\n",
+}
+
+
+@pytest.fixture
+def feed_path(tmp_path):
+    path = tmp_path / "gtfs.zip"
+    with zipfile.ZipFile(path, "w") as feed:
+        for name, content in FEED.items():
+            # some feeds have their files in a directory
+            feed.writestr(f"gtfs/{name}", content)
+    return str(path)
+
+
+def test_service_dates_apply_exceptions():
+    dates = service_dates(
+        pd.read_csv(io.StringIO(FEED["calendar.txt"]), dtype=str),
+        pd.read_csv(io.StringIO(FEED["calendar_dates.txt"]), dtype=str)
+    )
+    weekdays = dates.loc[dates["service_id"] == "weekdays", "date"].dt.day.tolist()
+    assert sorted(weekdays) == [6, 8, 9, 10, 12]
+    assert dates.loc[dates["service_id"] == "sundays", "date"].dt.day.tolist() == [12]
+
+
+def test_seconds_past_midnight():
+    times = seconds(pd.Series(["08:00:00", "25:10:00", "7:05:30", None]))
+    assert times.tolist()[:3] == [8 * 3600, 25 * 3600 + 600, 7 * 3600 + 330]
+    assert pd.isna(times.iloc[3])
+
+
+def test_read_feed_keeps_stops_in_bbox(feed_path):
+    stops, stop_times, dates = read_feed(feed_path, [24.8, 60.1, 25.1, 60.3], logging.getLogger("test"))
+    assert stops["stop_id"].tolist() == ["a"]
+    assert stops["geometry"].iloc[0].x == 24.94
+    assert sorted(stop_times["trip_id"]) == ["night", "sunday", "weekday"]
+    night = stop_times[stop_times["trip_id"] == "night"].iloc[0]
+    assert night["departure_time"] == 25 * 3600 + 600
+    assert night["service_id"] == "weekdays"
+    assert set(dates["service_id"]) == {"weekdays", "sundays"}
+
+
+def test_frequencies_per_day_and_window(feed_path):
+    logger = logging.getLogger("test")
+    stops = frequencies(*read_feed(feed_path, [24.8, 60.1, 25.1, 60.3], logger), logger)
+    assert stops["stop_id"].tolist() == ["a"]
+    stop = stops.iloc[0]
+    # the busiest day is sunday 2021-09-12, when both services run
+    assert stop["ntrips"] == 3
+    # the busiest weekday has no sunday trips
+    assert stop["ntrips_weekday"] == 2
+    assert stop["ntrips_weekday_morning"] == 1
+    assert stop["ntrips_weekday_evening"] == 0
+    # the weekday service runs on the sunday too
+    assert stop["ntrips_weekend"] == 3
+    assert stop["ntrips_weekend_morning"] == 1
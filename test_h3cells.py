@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from pyproj import Transformer
+
+from h3cells import cells, centroids, covering, parent
+
+# https://h3geo.org/docs/core-library/h3Indexing
+CELL = int("8828308281fffff", 16)
+
+
+def test_parent_of_single_cell():
+    assert parent(CELL, 8) == CELL
+    assert parent(CELL, 7) == int("872830828ffffff", 16)
+    assert parent(CELL, 5) == int("85283083fffffff", 16)
+    assert parent(CELL, 0) == int("8029fffffffffff", 16)
+
+
+def test_parent_of_cell_array():
+    cells = np.array([CELL, CELL], dtype=np.int64)
+    assert (parent(cells, 7) == int("872830828ffffff", 16)).all()
+
+
+def test_cells_of_points():
+    # the center of the cell is in the cell
+    xs, ys = centroids(np.array([CELL]))
+    assert cells(xs, ys, resolution=8).tolist() == [CELL]
+    assert cells(xs, ys, resolution=7).tolist() == [parent(CELL, 7)]
+
+
+def test_cells_of_projected_points():
+    xs, ys = centroids(np.array([CELL]))
+    mercator_xs, mercator_ys = Transformer.from_crs(4326, 3857, always_xy=True).transform(xs, ys)
+    assert cells(mercator_xs, mercator_ys, srid=3857, resolution=8).tolist() == [CELL]
+
+
+def test_centroids_of_cells():
+    # https://h3geo.org/docs/core-library/h3Indexing, the cell is in San Francisco
+    xs, ys = centroids(np.array([CELL, CELL]))
+    assert xs.tolist() == pytest.approx([-122.4, -122.4], abs=0.1)
+    assert ys.tolist() == pytest.approx([37.8, 37.8], abs=0.1)
+
+
+def test_covering_contains_the_cells_of_the_bbox():
+    xs, ys = centroids(np.array([CELL]))
+    x, y = xs[0], ys[0]
+    # the bbox is smaller than a cell at resolution 5
+    covered = covering([x - 0.001, y - 0.001, x + 0.001, y + 0.001], 5)
+    assert parent(CELL, 5) in covered
+    # the neighbours of the cell are included, too
+    assert len(covered) == 7
+    bbox = [x - 0.1, y - 0.1, x + 0.1, y + 0.1]
+    covered = covering(bbox, 8)
+    assert CELL in covered
+    corners = cells(np.array([bbox[0], bbox[2]]), np.array([bbox[1], bbox[3]]), resolution=8)
+    assert set(corners.tolist()) <= covered
@@ -0,0 +1,49 @@
+import numpy as np
+from pandas import Series
+from shapely.geometry import Point
+
+from loader import LineReader, _encode, _encode_column, _encode_points
+
+
+def test_encode_escapes_copy_text():
+    assert _encode(None, False, None) == "\\N"
+    assert _encode("tab\there\nback\\slash", False, None) == "tab\\there\\nback\\\\slash"
+    assert _encode(True, False, None) == "t"
+    assert _encode(3.5, False, None) == "3.5"
+
+
+def test_encode_json_and_geometry():
+    assert _encode({"name": "Kallio\tbar"}, False, None) == '{"name": "Kallio\\\\tbar"}'
+    ewkb = _encode(Point(24.9, 60.2), True, 4326)
+    # little endian point with srid flag, then srid 4326
+    assert ewkb.startswith("0101000020E6100000")
+
+
+def test_line_reader_streams_all_lines_in_chunks():
+    lines = [f"{index}\tline\n" for index in range(1000)]
+    reader = LineReader(iter(lines))
+    chunks = []
+    while True:
+        chunk = reader.read(100)
+        if not chunk:
+            break
+        assert len(chunk) <= 100
+        chunks.append(chunk)
+    assert "".join(chunks) == "".join(lines)
+
+
+def test_encode_points_as_shapely_does():
+    xs = np.array([24.9, -73.5])
+    ys = np.array([60.2, 45.5])
+    for srid in (4326, None):
+        expected = [_encode(Point(x, y), True, srid) for x, y in zip(xs, ys)]
+        assert list(_encode_points(xs, ys, srid)) == expected
+
+
+def test_encode_column_escapes_copy_text():
+    assert list(_encode_column(Series(["tab\there", None]))) == ["tab\\there", "\\N"]
+    assert list(_encode_column(Series(["new\nline", "back\\slash", None], dtype="string"))) == [
+        "new\\nline", "back\\\\slash", "\\N"
+    ]
+    assert list(_encode_column(Series([1.5, np.nan]))) == ["1.5", "\\N"]
+    assert list(_encode_column(Series([True, False]))) == ["t", "f"]
@@ -0,0 +1,15 @@
+from pandas import DataFrame
+
+from osm_tags import classify
+
+
+def test_classify_by_first_matching_tag():
+    tags = DataFrame({
+        "amenity": ["restaurant", "parking", None, "cafe"],
+        "shop": [None, None, "bakery", "coffee"],
+    })
+    assert list(classify(tags)) == ["amenity", None, "shop", "amenity"]
+
+
+def test_classify_without_tag_columns():
+    assert list(classify(DataFrame({"highway": ["bus_stop"]}))) == [None]
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from quadkeys import centers, covering, parent
+
+# https://learn.microsoft.com/en-us/bingmaps/articles/bing-maps-tile-system
+# tile x 3, y 5 at zoom 3
+QUADKEY = 213
+
+
+def test_centers_of_tiles():
+    xs, ys = centers(np.array([QUADKEY]), zoom=3)
+    assert xs[0] == pytest.approx(-22.5)
+    # between the north and south edges of the tile
+    assert ys[0] == pytest.approx((-40.9799 - 66.5133) / 2, abs=1e-3)
+
+
+def test_covering_contains_the_tile():
+    assert covering([-22.6, -50.1, -22.4, -49.9], 3) == [QUADKEY]
+    assert len(covering([-22.6, -50.1, 22.6, -49.9], 3)) == 2
+
+
+def test_parent():
+    assert list(parent(np.array([2130123012301230]), 8)) == [21301230]
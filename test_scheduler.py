@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from scheduler import MemoryScheduler, Stage
+
+
+def tracking_stages(memory_by_dataset, duration=0.05):
+    """Stages that record how much memory was reserved while they ran."""
+    lock = threading.Lock()
+    state = {"reserved": 0, "peak": 0, "concurrent": 0, "max_concurrent": 0}
+
+    def make_run(memory):
+        def run():
+            with lock:
+                state["reserved"] += memory
+                state["concurrent"] += 1
+                state["peak"] = max(state["peak"], state["reserved"])
+                state["max_concurrent"] = max(state["max_concurrent"], state["concurrent"])
+            time.sleep(duration)
+            with lock:
+                state["reserved"] -= memory
+                state["concurrent"] -= 1
+        return run
+
+    stages = [Stage(dataset, memory, make_run(memory)) for dataset, memory in memory_by_dataset.items()]
+    return stages, state
+
+
+def test_stages_stay_within_budget():
+    stages, state = tracking_stages({"osm": 2, "flickr": 1, "gtfs": 2, "access": 6, "ookla": 4, "kontur": 4})
+    finished = []
+    MemoryScheduler(6, 8, logging.getLogger("test")).run(stages, finished.append)
+
+    assert sorted(finished) == sorted(stage.dataset for stage in stages)
+    assert state["peak"] <= 8
+    assert state["max_concurrent"] > 1
+
+
+def test_parallel_limit():
+    stages, state = tracking_stages({"osm": 1, "flickr": 1, "gtfs": 1, "ookla": 1})
+    MemoryScheduler(2, 100, logging.getLogger("test")).run(stages, lambda dataset: None)
+
+    assert state["max_concurrent"] == 2
+
+
+def test_parallel_limit_without_budget():
+    stages, state = tracking_stages({"access": 6, "osm": 2, "ookla": 4})
+    MemoryScheduler(2, None, logging.getLogger("test")).run(stages, lambda dataset: None)
+
+    assert state["max_concurrent"] == 2
+
+
+def test_oversized_stage_runs_alone():
+    stages, state = tracking_stages({"access": 6, "osm": 2})
+    finished = []
+    MemoryScheduler(2, 4, logging.getLogger("test")).run(stages, finished.append)
+
+    assert finished == ["access", "osm"]
+    assert state["max_concurrent"] == 1
+
+
+def test_failure_stops_new_stages():
+    started = []
+
+    def fail():
+        started.append("osm")
+        raise ValueError("Overpass API is down")
+
+    stages = [
+        Stage("osm", 4, fail),
+        Stage("kontur", 4, lambda: started.append("kontur")),
+    ]
+    finished = []
+    with pytest.raises(ValueError):
+        MemoryScheduler(2, 4, logging.getLogger("test")).run(stages, finished.append)
+
+    assert started == ["osm"]
+    assert finished == []
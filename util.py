@@ -1,3 +1,5 @@
+import hashlib
+import json
 import logging
 import sys
 from pathlib import Path
@@ -32,3 +34,8 @@ def create_logger(slug: str) -> logging.Logger:
     logger.addHandler(file_handler)
 
     return logger
+
+
+def fingerprint(*parts) -> str:
+    """Returns a hash of JSON serializable parts, e.g. the parameters of an import."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
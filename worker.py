@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import argparse
+import datetime
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import sys
+from logging import Logger
+from time import sleep
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy.orm import sessionmaker
+
+from db import get_engine
+from jobs import CHANNEL, FAILED, FINISHED, JOB_NAMESPACE, QUEUED, RUNNING, CANCELLED, delete_analysis, finish, \
+    requeue_orphans
+from models import Job
+from util import create_logger
+
+load_dotenv()
+IMPORT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "import.py")
+# New and cancelled jobs wake up the workers at once. Dead workers can't
+# notify anybody, so check the queue every now and then anyway.
+POLL_INTERVAL = 10.0
+
+
+class Worker(object):
+    """Runs import jobs from the job queue, one at a time.
+
+    Each job is run in a child process forked from the worker. Warm workers
+    have imported all the importers already, so the child can start
+    importing right away instead of starting a new interpreter.
+    """
+
+    def __init__(self, name: str, logger: Logger, warm: bool = False):
+        self.name = name
+        self.logger = logger
+        self.warm = warm
+        engine = get_engine()
+        Job.__table__.create(engine, checkfirst=True)
+        self.session = sessionmaker(bind=engine)()
+        # The connection listens to job notifications and holds the advisory
+        # locks of our running jobs. It must never go back to the pool.
+        self.connection = engine.raw_connection()
+        self.connection.detach()
+        self.connection.connection.autocommit = True
+        self.cursor = self.connection.cursor()
+        self.cursor.execute(f"LISTEN {CHANNEL}")
+
+    def run(self):
+        self.logger.info(f"Worker {self.name} waiting for jobs...")
+        while True:
+            requeue_orphans(self.session)
+            job = self._claim()
+            if job:
+                self._run_job(job)
+            else:
+                self._wait()
+
+    def _claim(self) -> Job:
+        job = self.session.query(Job).filter(
+            Job.status == QUEUED
+        ).order_by(Job.id).with_for_update(skip_locked=True).first()
+        if job:
+            # lock the job before anybody else may see it running
+            self.cursor.execute("SELECT pg_advisory_lock(%s, %s)", (JOB_NAMESPACE, job.id))
+            job.status = RUNNING
+            job.worker = self.name
+            job.started = datetime.datetime.now()
+        self.session.commit()
+        return job
+
+    def _run_job(self, job: Job):
+        self.logger.info(f"Worker {self.name} importing {job.city}...")
+        process = multiprocessing.get_context("fork").Process(
+            target=run_job, args=(job.arguments, job.environment, self.warm), name=job.slug
+        )
+        process.start()
+        try:
+            while process.is_alive():
+                self._wait(process.sentinel)
+                status = self.session.query(Job.status).filter(Job.id == job.id).scalar()
+                self.session.commit()
+                if status == CANCELLED and process.is_alive():
+                    self.logger.info(f"Import of {job.city} cancelled, terminating...")
+                    process.terminate()
+                    process.join()
+            if process.exitcode == 0:
+                finish(self.session, job, FINISHED)
+            else:
+                finish(self.session, job, FAILED, f"Import exited with code {process.exitcode}")
+            if job.status == CANCELLED:
+                # the import has stopped, so it can't write to the schema any more
+                self.logger.info(f"Deleting cancelled analysis of {job.city}...")
+                delete_analysis(self.session, job.slug)
+            self.logger.info(f"Worker {self.name} done with {job.city}, status {job.status}")
+        except BaseException:
+            # we are shutting down. The job will be run again by the next worker.
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            self.session.rollback()
+            if job.status != CANCELLED:
+                job.status = QUEUED
+                job.worker = None
+            self.session.commit()
+            if job.status == CANCELLED:
+                delete_analysis(self.session, job.slug)
+            raise
+        finally:
+            self.cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (JOB_NAMESPACE, job.id))
+
+    def _wait(self, *sentinels):
+        """Waits for a notification, or for any of the sentinels to become ready."""
+        dbapi_connection = self.connection.connection
+        # a job may have been notified while we were querying the queue
+        dbapi_connection.poll()
+        if not dbapi_connection.notifies:
+            select.select([dbapi_connection, *sentinels], [], [], POLL_INTERVAL)
+            dbapi_connection.poll()
+        dbapi_connection.notifies.clear()
+
+
+def run_job(arguments: List[str], environment: Optional[Dict[str, str]], warm: bool):
+    # terminating the job must not look like a clean exit
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # e.g. API keys entered in the UI
+    os.environ.update(environment or {})
+    if not warm:
+        os.execv(sys.executable, [sys.executable, IMPORT_PATH] + arguments)
+    # imported by the worker pool already, this costs nothing
+    from pipeline import parser, run_import
+    run_import(vars(parser.parse_args(arguments)))
+
+
+def stop(signum, frame):
+    sys.exit(0)
+
+
+def work(name: str, warm: bool):
+    # don't inherit the pool signal handlers
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    Worker(name, create_logger("worker"), warm).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run import jobs queued in the UI")
+    parser.add_argument("--processes",
+                        type=int,
+                        default=int(os.getenv("IMPORT_WORKERS", 2)),
+                        help="Number of imports to run at the same time. Default is 2.")
+    parser.add_argument("--warm",
+                        action="store_true",
+                        default=False,
+                        help="Import all the importers and their libraries once when starting the workers,"
+                             " instead of starting a new import.py process for each job.")
+    args = vars(parser.parse_args())
+
+    logger = create_logger("worker")
+    host = socket.gethostname()
+    workers = {}
+
+    def shutdown(signum, frame):
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    if args["warm"]:
+        # osmnx, pandana, GDAL etc. are shared by all the workers
+        logger.info("Loading importers...")
+        import pipeline  # noqa: F401
+        from datasets import DATASETS, get_importer
+        for dataset in DATASETS:
+            get_importer(dataset)
+    # keep the pool full, workers may die e.g. if the database restarts
+    while True:
+        for index in range(args["processes"]):
+            name = f"{host}-{index}"
+            if name not in workers or not workers[name].is_alive():
+                if name in workers:
+                    logger.warning(f"Worker {name} died, restarting...")
+                workers[name] = multiprocessing.Process(target=work, args=(name, args["warm"]), name=name)
+                workers[name].start()
+        sleep(POLL_INTERVAL)